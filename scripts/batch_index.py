@@ -7,32 +7,61 @@ os.environ["MKL_NUM_THREADS"] = "1"
 os.environ["OPENBLAS_NUM_THREADS"] = "1"
 
 import sys
-import json
 import logging
 import gc
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Set
+from typing import Dict, Iterator, List, Tuple
 
 sys.path.insert(0, str(Path(__file__).parent.parent))
 
+from src.embedder import Embedder
+from src.embedding_cache import EmbeddingCache
 from src.indexing import IndexBuilder
+from src.processed_files import ProcessedFiles
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
 EMBEDDINGS_DIR = Path("embeddings")
-PROCESSED_FILES = EMBEDDINGS_DIR / "processed_files.json"
-SAVE_INTERVAL = 5
+PROCESSED_FILES = EMBEDDINGS_DIR / "processed_files.txt"
+SAVE_INTERVAL = 5  # この件数のPDFごとにまとめて埋め込み・追加し、保存する
 
 
-def load_processed() -> Set[str]:
-    if PROCESSED_FILES.exists():
-        return set(json.loads(PROCESSED_FILES.read_text(encoding='utf-8')))
-    return set()
+def prepare_ahead(builder: IndexBuilder, paths: List[Path]) -> Iterator[Tuple[Path, List[Dict], str]]:
+    """PDFを1件先にテキスト抽出・チャンク分割しながら順に返す
 
-
-def save_processed(files: Set[str]) -> None:
-    PROCESSED_FILES.write_text(json.dumps(list(files), ensure_ascii=False, indent=2), encoding='utf-8')
+    現在のファイルを埋め込んでいる間に次のファイルの読み込み・抽出をスレッドで進め、
+    ディスクI/O・抽出と推論を重ねる。メモリを抑えるため先読みは1件のみ。
+    """
+    if not paths:
+        return
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        future = pool.submit(builder.prepare_pdf, paths[0], paths[0].name)
+        for i, path in enumerate(paths):
+            metadata, msg = future.result()
+            if i + 1 < len(paths):
+                future = pool.submit(builder.prepare_pdf, paths[i + 1], paths[i + 1].name)
+            yield path, metadata, msg
+
+
+def add_batch(builder: IndexBuilder, batch: List[Tuple[Path, List[Dict]]]) -> List[Tuple[Path, int, str]]:
+    """準備済みの複数PDFをまとめて埋め込み・インデックスに追加
+
+    FAISS・BM25への追加を1回にまとめる（BM25の共通語のpostings書き換えがファイルごとでなく1回で済む）。
+    ベクトル追加前に失敗した場合は、原因のファイルを切り分けるため1件ずつやり直す。
+
+    Returns:
+        [(パス, 追加チャンク数, メッセージ), ...]
+    """
+    before = builder.indexer.get_vector_count()
+    count, msg = builder.add_chunks([m for _, metadata in batch for m in metadata])
+    if count > 0:
+        return [(path, len(metadata), msg) for path, metadata in batch]
+    if len(batch) > 1 and builder.indexer.get_vector_count() == before:
+        logger.warning(f"  まとめて追加できなかったため1件ずつ処理: {msg}")
+        return [(path, *builder.add_chunks(metadata)) for path, metadata in batch]
+    return [(path, 0, msg) for path, _ in batch]
 
 
 def main():
@@ -40,15 +69,27 @@ def main():
     parser = argparse.ArgumentParser(description="PDFバッチインデクシング")
     parser.add_argument("path", type=Path, help="PDFファイルまたはディレクトリ")
     parser.add_argument("-r", "--recursive", action="store_true", help="サブディレクトリも処理")
+    parser.add_argument("--embedding-cache", type=Path, metavar="DB",
+                        help="文書埋め込みのキャッシュ（再インデックス時に未変更チャンクの埋め込みを再利用）")
     args = parser.parse_args()
 
     EMBEDDINGS_DIR.mkdir(exist_ok=True)
 
     logger.info("モデルをロード中...")
-    builder = IndexBuilder()
+    embedder = Embedder()
+    document_cache = None
+    if args.embedding_cache:
+        # float16で保存（ヒット時もミス時も同じく丸めた値を使うため、結果は再現する）
+        document_cache = EmbeddingCache(str(args.embedding_cache), embedder.fingerprint, half=True)
+        embedder.document_cache = document_cache
+        logger.info(f"埋め込みキャッシュ: {args.embedding_cache} ({len(document_cache)}件)")
+    builder = IndexBuilder(embedder=embedder)
     builder.load()
     logger.info("モデルのロード完了")
 
+    # ロード済みモデル等の長寿命オブジェクトをGC走査の対象外にする
+    gc.freeze()
+
     # 整合性チェック
     ok, msg = builder.verify()
     if not ok:
@@ -56,7 +97,8 @@ def main():
         logger.error("embeddings/を削除して再インデックスしてください")
         return
 
-    processed = load_processed()
+    processed = ProcessedFiles(PROCESSED_FILES)
+    processed.load()
     logger.info(f"処理済み: {len(processed)}ファイル")
 
     # PDFリスト
@@ -68,44 +110,49 @@ def main():
 
     logger.info(f"対象: {len(files)}ファイル")
 
+    targets = [p for p in files if p.name not in processed]
+    skipped = len(files) - len(targets)
+
     total_files = 0
     total_pages = 0
-    skipped = 0
-
-    for i, path in enumerate(files, 1):
-        if path.name in processed:
-            skipped += 1
-            continue
 
-        logger.info(f"[{i}/{len(files)}] {path.name}")
-        pages, msg = builder.add_pdf_file(path)
-
-        if pages > 0:
-            total_files += 1
-            total_pages += pages
-            processed.add(path.name)
-            logger.info(f"  完了: {pages}ページ")
-
-            if total_files % SAVE_INTERVAL == 0:
-                logger.info("保存中...")
-                builder.save()
-                save_processed(processed)
-                gc.collect()
+    batch: List[Tuple[Path, List[Dict]]] = []
+    for i, (path, metadata, msg) in enumerate(prepare_ahead(builder, targets), 1):
+        logger.info(f"[{i}/{len(targets)}] {path.name}")
+        if metadata:
+            batch.append((path, metadata))
         else:
             logger.warning(f"  スキップ: {msg}")
             processed.add(path.name)
+
+        if batch and (len(batch) >= SAVE_INTERVAL or i == len(targets)):
+            for done, pages, msg in add_batch(builder, batch):
+                processed.add(done.name)
+                if pages > 0:
+                    total_files += 1
+                    total_pages += pages
+                    logger.info(f"  完了: {done.name} {pages}ページ")
+                else:
+                    logger.warning(f"  スキップ: {done.name} {msg}")
+            batch = []
+
+            logger.info("保存中...")
+            builder.save()
+            processed.save()
             gc.collect()
 
     # 最終保存
     logger.info("最終保存中...")
     builder.save()
-    save_processed(processed)
+    processed.save()
 
     stats = builder.stats
     logger.info("=" * 50)
     logger.info(f"処理完了: {total_files}ファイル, {total_pages}ページ")
     logger.info(f"スキップ: {skipped}ファイル (処理済み)")
     logger.info(f"合計: ベクトル{stats['vectors']}件, メタデータ{stats['metadata']}件")
+    if document_cache is not None:
+        logger.info(f"埋め込みキャッシュ: ヒット{document_cache.hits}件, ミス{document_cache.misses}件")
     logger.info("=" * 50)
 
 
@@ -1,41 +1,105 @@
 """API サーバー - FastAPIによる検索エンドポイント"""
 
 import os
+# ライブラリ内部のスレッドを固定（リクエスト並列とのオーバーサブスクリプション防止）
 os.environ.setdefault("OMP_NUM_THREADS", "1")
 os.environ.setdefault("MKL_NUM_THREADS", "1")
+os.environ.setdefault("OPENBLAS_NUM_THREADS", "1")
 
-from fastapi import FastAPI, UploadFile, File, HTTPException, Query
+from fastapi import FastAPI, UploadFile, File, HTTPException, Query, Request, BackgroundTasks
 from pydantic import BaseModel
-from typing import List, Optional
-import json
+from contextlib import asynccontextmanager
+from dataclasses import replace
+from typing import List, Literal, Optional
+import asyncio
 import logging
+import shutil
+import tempfile
+import time
+import uuid
 from pathlib import Path
 
+import faiss
+
 from .indexing import IndexBuilder
 from .hybrid_searcher import HybridSearcher, SearchConfig
+from .processed_files import ProcessedFiles
+from .query_batcher import QueryBatcher
+from .rw_lock import ReadWriteLock
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
 EMBEDDINGS_DIR = Path("embeddings")
-PROCESSED_FILES_PATH = EMBEDDINGS_DIR / "processed_files.json"
-EMBEDDINGS_DIR.mkdir(exist_ok=True)
+PROCESSED_FILES_PATH = EMBEDDINGS_DIR / "processed_files.txt"
+UPLOADS_DIR = EMBEDDINGS_DIR / "uploads"  # 処理待ちPDFの一時置き場
+STATUS_TTL = 5.0  # /statusの結果をキャッシュする秒数
+MAX_JOBS = 1000  # 保持するアップロードジョブ数（超えたら完了済みの古いものから削除）
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """起動時にモデルとインデックスを1回だけロード
+
+    import時ではなくワーカー起動時に初期化するため、import しただけでモデルをロードしない。
+    状態は app.state に保持する。
+    """
+    faiss.omp_set_num_threads(int(os.environ.get("FAISS_THREADS", "1")))
+
+    EMBEDDINGS_DIR.mkdir(exist_ok=True)
+    UPLOADS_DIR.mkdir(exist_ok=True)
+    # 前回の異常終了で残った処理待ちファイルを削除（ジョブ情報はメモリ上のみのため再開できない）
+    for stale in UPLOADS_DIR.glob("*.pdf"):
+        stale.unlink()
+
+    logger.info("モデルをロード中...")
+    builder = IndexBuilder()
+    builder.load()
+
+    ok, msg = builder.verify()
+    if not ok:
+        logger.error(f"データ整合性エラー: {msg}")
+    else:
+        logger.info(f"データ整合性OK: {msg}")
+
+    processed_files = ProcessedFiles(PROCESSED_FILES_PATH)
+    processed_files.load()
+
+    app.state.builder = builder
+    app.state.hybrid_searcher = HybridSearcher(builder.embedder, builder.indexer, builder.bm25)
+    app.state.processed_files = processed_files
+    app.state.query_batcher = QueryBatcher(builder.embedder.generate_query_embeddings)
+    app.state.upload_lock = asyncio.Lock()
+    # 追加・保存（排他）と検索（共有）の直列化。アップロード同士の順序はupload_lockで決める
+    app.state.index_lock = ReadWriteLock()
+    app.state.status_cache = None
+    app.state.jobs = {}  # job_id -> {"status", "filename", ...}
+    app.state.unsaved = False  # 未保存の追加があるか
+    app.state.pending_jobs = []  # 追加済みで保存待ちのジョブ（保存に成功したらdoneにする）
+
+    # 初回リクエストの遅延を避けるため、埋め込み・ベクトル検索・BM25を一度通しておく
+    # リランカーはメモリ節約のため遅延ロードのまま（hybridモードのみの運用では読み込まない）
+    try:
+        await asyncio.to_thread(
+            app.state.hybrid_searcher.search, "ウォームアップ", 1, SEARCH_CONFIGS["hybrid"]
+        )
+    except Exception as e:
+        logger.warning(f"ウォームアップ失敗: {e}")
+
+    logger.info("モデルのロード完了")
+    yield
+
+    await _save_on_shutdown(app.state)
 
-# 初期化
-logger.info("モデルをロード中...")
-builder = IndexBuilder()
-builder.load()
-hybrid_searcher = HybridSearcher(builder.embedder, builder.indexer, builder.bm25)
 
-ok, msg = builder.verify()
-if not ok:
-    logger.error(f"データ整合性エラー: {msg}")
-else:
-    logger.info(f"データ整合性OK: {msg}")
+app = FastAPI(title="Kugutsushi Search API", version="1.0.0", lifespan=lifespan)
 
-logger.info("モデルのロード完了")
 
-app = FastAPI(title="Kugutsushi Search API", version="1.0.0")
+# モードごとの検索設定（リクエスト毎に生成しない）
+SEARCH_CONFIGS = {
+    "hybrid": SearchConfig(use_bm25=True, use_rerank=False),
+    "hybrid+rerank": SearchConfig(use_bm25=True, use_rerank=True),
+}
 
 
 class SearchResult(BaseModel):
@@ -49,53 +113,191 @@ class SearchResponse(BaseModel):
     results: List[SearchResult]
 
 
-def load_processed_files() -> set:
-    if PROCESSED_FILES_PATH.exists():
-        return set(json.loads(PROCESSED_FILES_PATH.read_text(encoding='utf-8')))
-    return set()
+def _prune_jobs(jobs: dict) -> None:
+    """完了済みの古いジョブを削除してMAX_JOBS件以内に保つ"""
+    for job_id in [k for k, v in jobs.items() if v["status"] in ("done", "error")]:
+        if len(jobs) <= MAX_JOBS:
+            break
+        del jobs[job_id]
 
 
-def save_processed_files(files: set) -> None:
-    PROCESSED_FILES_PATH.write_text(json.dumps(list(files), ensure_ascii=False, indent=2), encoding='utf-8')
+def _exclusive(state, func, *args):
+    """インデックスを変更する処理を排他ロック下で実行（asyncio.to_threadのワーカー内で呼ぶ）"""
+    with state.index_lock.write():
+        return func(*args)
 
 
-processed_files = load_processed_files()
+def _shared(state, func, *args):
+    """インデックスを読む処理を共有ロック下で実行（asyncio.to_threadのワーカー内で呼ぶ）"""
+    with state.index_lock.read():
+        return func(*args)
 
 
-@app.post("/upload")
-async def upload_file(file: UploadFile = File(...)):
-    """PDFをアップロードしてインデックスに追加"""
+def _spool_to_disk(src, dst_dir: Path) -> Path:
+    """アップロードをチャンク単位でディスクに書き出す（PDF全体をメモリに載せない）"""
+    fd, tmp = tempfile.mkstemp(suffix=".pdf", dir=dst_dir)
+    with os.fdopen(fd, "wb") as dst:
+        shutil.copyfileobj(src, dst, 1 << 20)
+    return Path(tmp)
+
+
+async def process_upload(state, job_id: str, pdf_path: Path, filename: str) -> None:
+    """アップロードされたPDFをインデックスに追加（バックグラウンド実行）
+
+    抽出・埋め込み・保存はスレッドで実行し、イベントループを塞がない。
+    インデックスはスレッドセーフでないため、更新はupload_lockで直列化し、
+    インデックスへの追加・保存だけを検索とindex_lockで排他にする（追加中のインデックスを検索が読まない）。
+    処理後、一時ファイルpdf_pathは削除する。
+    """
+    try:
+        await _process_upload(state, state.jobs[job_id], pdf_path, filename)
+    finally:
+        pdf_path.unlink(missing_ok=True)
+
+
+async def _process_upload(state, job: dict, pdf_path: Path, filename: str) -> None:
+    async with state.upload_lock:
+        try:
+            if filename in state.processed_files:
+                job.update(status="error", message=f"{filename}は処理済み")
+                return
+
+            job["status"] = "processing"
+            logger.info(f"PDF処理開始: {filename}")
+            # 抽出と埋め込みはインデックスを変更しないため、ロックの外で実行して検索を止めない
+            metadata, msg = await asyncio.to_thread(state.builder.prepare_pdf, pdf_path, filename)
+            if not metadata:
+                job.update(status="error", message=msg)
+                return
+            vectors, msg = await asyncio.to_thread(state.builder.embed_chunks, metadata)
+            if vectors is None:
+                job.update(status="error", message=msg)
+                return
+            pages, msg = await asyncio.to_thread(
+                _exclusive, state, state.builder.index_chunks, metadata, vectors
+            )
+            if pages == 0:
+                job.update(status="error", message=msg)
+                return
+
+            # 保存に成功するまではprocessingのまま（保存失敗時にdoneを返さない）
+            state.processed_files.add(filename)
+            state.unsaved = True
+            job.update(message=msg, texts_count=pages)
+            state.pending_jobs.append(job)
+        except Exception as e:
+            logger.error(f"PDF処理エラー: {filename}: {e}")
+            job.update(status="error", message=str(e))
+        finally:
+            state.status_cache = None
+            # 後続ジョブが待っていれば保存をまとめる（保存はインデックス全体の書き出しのため）
+            if state.unsaved and not _has_queued_jobs(state.jobs):
+                await _save_index(state)
+
+
+def _has_queued_jobs(jobs: dict) -> bool:
+    return any(j["status"] == "queued" for j in jobs.values())
+
+
+async def _save_index(state) -> None:
+    """インデックスを保存してから処理済みファイルを記録し、保存待ちのジョブを完了にする
+
+    クラッシュ時は処理済みに未記録のまま残り、再処理される。
+    インデックスの保存に失敗しても、追加済みのデータはメモリ上のインデックスに残っているため、
+    処理済みの記録とジョブは保存待ちのまま残し、次のアップロード後か終了時に保存をやり直す
+    （処理済みから外すと再アップロードで同じPDFが二重に追加される）。
+    """
+    try:
+        await asyncio.to_thread(_exclusive, state, state.builder.save)
+    except Exception as e:
+        logger.error(f"インデックス保存エラー: {e}")
+        for job in state.pending_jobs:
+            job["save_error"] = f"インデックス保存エラー: {e}"
+        return
+
+    pending, state.pending_jobs = state.pending_jobs, []
+    state.unsaved = False
+    for job in pending:
+        job.pop("save_error", None)
+        job["status"] = "done"
+    try:
+        await asyncio.to_thread(state.processed_files.save)
+    except Exception as e:
+        # インデックスは保存済み。処理済みの記録はメモリ上に残り、次回の保存で書き出す
+        logger.error(f"処理済みファイル保存エラー: {e}")
+
+
+async def _save_on_shutdown(state) -> None:
+    """保存に失敗したままの追加があれば、終了前にもう一度保存する"""
+    async with state.upload_lock:
+        if state.unsaved:
+            await _save_index(state)
+
+
+@app.post("/upload", status_code=202)
+async def upload_file(request: Request, background: BackgroundTasks, file: UploadFile = File(...)):
+    """PDFを受け付け、インデックスへの追加をバックグラウンドで実行
+
+    進捗は GET /jobs/{job_id} で確認する。
+    """
+    state = request.app.state
+
     if not file.filename.endswith('.pdf'):
         raise HTTPException(400, "PDFファイルのみ対応")
 
-    if file.filename in processed_files:
+    if file.filename in state.processed_files:
         raise HTTPException(400, f"{file.filename}は処理済み")
 
-    content = await file.read()
-    logger.info(f"PDF処理開始: {file.filename}")
+    if any(
+        j["filename"] == file.filename and j["status"] in ("queued", "processing")
+        for j in state.jobs.values()
+    ):
+        raise HTTPException(400, f"{file.filename}は処理待ち")
 
-    pages, msg = builder.add_pdf(content, file.filename)
+    pdf_path = await asyncio.to_thread(_spool_to_disk, file.file, UPLOADS_DIR)
 
-    if pages == 0:
-        raise HTTPException(400, msg)
+    job_id = uuid.uuid4().hex
+    state.jobs[job_id] = {"status": "queued", "filename": file.filename}
+    _prune_jobs(state.jobs)
+    background.add_task(process_upload, state, job_id, pdf_path, file.filename)
 
-    builder.save()
-    processed_files.add(file.filename)
-    save_processed_files(processed_files)
+    return {"job_id": job_id, "status": "queued", "filename": file.filename}
 
-    return {"message": f"{file.filename}を処理しました", "texts_count": pages}
+
+@app.get("/jobs/{job_id}")
+async def job_status(request: Request, job_id: str):
+    """アップロードジョブの状態（queued / processing / done / error）"""
+    job = request.app.state.jobs.get(job_id)
+    if job is None:
+        raise HTTPException(404, f"ジョブが見つかりません: {job_id}")
+    return {"job_id": job_id, **job}
 
 
 @app.get("/search", response_model=SearchResponse)
 async def search(
+    request: Request,
     query: str,
     top_k: Optional[int] = Query(3, ge=1, le=100),
-    mode: Optional[str] = Query("hybrid+rerank", regex="^(hybrid|hybrid\\+rerank)$"),
+    mode: Literal["hybrid", "hybrid+rerank"] = Query("hybrid+rerank"),
+    ef_search: Optional[int] = Query(None, ge=1, le=1024),
 ):
-    """ハイブリッド検索"""
+    """ハイブリッド検索
+
+    ef_search: HNSWの探索幅（再現率と速度のトレードオフ、指定時のみ上書き）
+    """
+    state = request.app.state
+    # 埋め込み・BM25・リランキング（とそのキャッシュ）で同じ文字列を使う
+    query = query.strip()
+    config = SEARCH_CONFIGS[mode]
+    if ef_search is not None:
+        config = replace(config, ef_search=ef_search)
     try:
-        config = SearchConfig(use_bm25=True, use_rerank=(mode == "hybrid+rerank"))
-        results = hybrid_searcher.search(query, top_k, config)
+        # クエリ埋め込みは同時リクエストとまとめてバッチ計算
+        query_vec = await state.query_batcher.embed(query)
+        # BM25・リランキングもCPU処理のためスレッドで実行（追加・保存中は共有ロックで待つ）
+        results = await asyncio.to_thread(
+            _shared, state, state.hybrid_searcher.search_with_query_vector, query, query_vec, top_k, config
+        )
 
         return SearchResponse(results=[
             SearchResult(text=m["text"], score=float(s), file=m["file"], page=m["page"])
@@ -107,10 +309,10 @@ async def search(
 
 
 @app.get("/books")
-async def books():
+async def books(request: Request):
     """インデックス済み書籍の一覧"""
     try:
-        file_list = builder.indexer.db.get_file_list()
+        file_list = await asyncio.to_thread(request.app.state.builder.indexer.db.get_file_list)
         return {"total": len(file_list), "books": file_list}
     except Exception as e:
         logger.error(f"書籍一覧エラー: {e}")
@@ -118,10 +320,12 @@ async def books():
 
 
 @app.get("/books/{filename:path}")
-async def book_content(filename: str):
+async def book_content(request: Request, filename: str):
     """特定書籍の全チャンクをページ順で取得"""
     try:
-        chunks = builder.indexer.db.get_metadata_by_file(filename)
+        chunks = await asyncio.to_thread(
+            request.app.state.builder.indexer.db.get_metadata_by_file, filename
+        )
         if not chunks:
             raise HTTPException(404, f"書籍が見つかりません: {filename}")
         return {"filename": filename, "total_chunks": len(chunks), "chunks": chunks}
@@ -132,19 +336,31 @@ async def book_content(filename: str):
         raise HTTPException(500, str(e))
 
 
-@app.get("/status")
-async def status():
-    """システム状態"""
+def _verify_and_stats(builder: IndexBuilder):
     ok, msg = builder.verify()
-    stats = builder.stats
-    return {
+    return ok, msg, builder.stats
+
+
+@app.get("/status")
+async def status(request: Request):
+    """システム状態（STATUS_TTL秒キャッシュ、アップロードで無効化）"""
+    state = request.app.state
+    now = time.monotonic()
+    if state.status_cache is not None and now - state.status_cache[0] < STATUS_TTL:
+        return state.status_cache[1]
+
+    ok, msg, stats = await asyncio.to_thread(_shared, state, _verify_and_stats, state.builder)
+    result = {
         "integrity": ok,
         "message": msg,
         "vectors": stats["vectors"],
         "metadata": stats["metadata"],
         "bm25": stats["bm25"],
-        "processed_files": len(processed_files)
+        "processed_files": len(state.processed_files),
+        "query_cache": {"hits": state.query_batcher.hits, "misses": state.query_batcher.misses},
     }
+    state.status_cache = (now, result)
+    return result
 
 
 if __name__ == "__main__":
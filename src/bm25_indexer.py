@@ -1,15 +1,28 @@
 """BM25インデックス - SQLite + 語彙削減による軽量キーワード検索"""
 
 from typing import List, Dict, Tuple
+from collections import Counter
 import sqlite3
 import logging
 from pathlib import Path
 import re
-import math
-import struct
+import numpy as np
+import orjson
 
 logger = logging.getLogger(__name__)
 
+# postings blobの形式（v2）:
+#   [ヘッダ 1byte][doc_idの差分 × n][tf × n]
+#   ヘッダ下位2bit: 差分の幅（0: u8, 1: u16, 2: u32）、bit2: tfの幅（0: u8, 1: u16）
+# doc_idは昇順なので差分は小さく、tfもほぼ1桁のため、旧形式（6byte固定）の約半分になる
+POSTINGS_FORMAT = 2
+DELTA_DTYPES = (np.dtype('<u1'), np.dtype('<u2'), np.dtype('<u4'))
+TF_DTYPES = (np.dtype('<u1'), np.dtype('<u2'))
+# 旧形式（v1）: [doc_id (uint32), tf (uint16)] の繰り返し。読み込み時に移行する
+LEGACY_POSTING_DTYPE = np.dtype([('doc_id', '<u4'), ('tf', '<u2')])
+TOKEN_PATTERN = re.compile(r'[\w\u3040-\u309f\u30a0-\u30ff\u4e00-\u9fff]+')
+SQL_VARIABLE_LIMIT = 900  # 1文あたりのプレースホルダ数（SQLiteの上限999未満）
+
 
 class BM25Indexer:
     """SQLiteベースのBM25インデックス（効率的なスキーマ）
@@ -26,6 +39,7 @@ class BM25Indexer:
         self.b = 0.75
         self.min_df = min_df  # 最低出現文書数（これ未満の語は無視）
         self._conn = None
+        self._doc_norms = None  # doc_id -> 文書長正規化項の密な配列（search用キャッシュ、addで破棄）
         self._init_db()
 
     def _get_conn(self) -> sqlite3.Connection:
@@ -55,32 +69,115 @@ class BM25Indexer:
         """)
         conn.commit()
 
+        row = conn.execute("SELECT value FROM stats WHERE key = 'postings_format'").fetchone()
+        if row is None:
+            if conn.execute("SELECT 1 FROM terms LIMIT 1").fetchone():
+                self._migrate_postings_format()
+            else:
+                conn.execute("INSERT INTO stats VALUES ('postings_format', ?)", (POSTINGS_FORMAT,))
+                conn.commit()
+
+    def _migrate_postings_format(self) -> None:
+        """旧形式（6byte固定長）のpostingsを差分+可変幅形式に変換（1トランザクション）"""
+        logger.info("BM25 postingsを新形式に変換中...")
+        conn = self._get_conn()
+        last_rowid = -1
+        converted = 0
+        while True:
+            rows = conn.execute(
+                "SELECT rowid, postings FROM terms WHERE rowid > ? ORDER BY rowid LIMIT 10000",
+                (last_rowid,)
+            ).fetchall()
+            if not rows:
+                break
+            updates = []
+            for rowid, blob in rows:
+                arr = np.frombuffer(blob, dtype=LEGACY_POSTING_DTYPE)
+                updates.append((self._encode_arrays(arr['doc_id'], arr['tf']), rowid))
+            conn.executemany("UPDATE terms SET postings = ? WHERE rowid = ?", updates)
+            last_rowid = rows[-1][0]
+            converted += len(rows)
+        conn.execute("INSERT INTO stats VALUES ('postings_format', ?)", (POSTINGS_FORMAT,))
+        conn.commit()
+        conn.execute("VACUUM")
+        logger.info(f"BM25 postings変換完了: {converted:,}語")
+
     def _encode_postings(self, postings: Dict[int, int]) -> bytes:
-        """postings dict を効率的なバイナリにエンコード"""
-        # フォーマット: [doc_id (4bytes), tf (2bytes)] の繰り返し
-        data = []
-        for doc_id, tf in sorted(postings.items()):
-            data.append(struct.pack('<IH', doc_id, min(tf, 65535)))
-        return b''.join(data)
-
-    def _decode_postings(self, blob: bytes) -> List[Tuple[int, int]]:
-        """バイナリから postings をデコード"""
-        result = []
-        for i in range(0, len(blob), 6):
-            doc_id, tf = struct.unpack('<IH', blob[i:i+6])
-            result.append((doc_id, tf))
-        return result
+        """postings dict を効率的なバイナリにエンコード（doc_id昇順）"""
+        n = len(postings)
+        doc_ids = np.fromiter(postings.keys(), dtype=np.int64, count=n)
+        tfs = np.fromiter(postings.values(), dtype=np.int64, count=n)
+        order = np.argsort(doc_ids, kind='stable')
+        return self._encode_arrays(doc_ids[order], tfs[order])
+
+    def _encode_arrays(self, doc_ids: np.ndarray, tfs: np.ndarray) -> bytes:
+        """昇順のdoc_id配列とtf配列をエンコード"""
+        return self._encode_deltas(np.diff(doc_ids.astype(np.int64), prepend=0), tfs)
+
+    def _encode_deltas(self, deltas: np.ndarray, tfs: np.ndarray) -> bytes:
+        """doc_idの差分配列とtf配列をエンコード"""
+        tfs = np.minimum(tfs, 65535)
+        max_delta = int(deltas.max()) if len(deltas) else 0
+        max_tf = int(tfs.max()) if len(tfs) else 0
+        delta_code = 0 if max_delta < 1 << 8 else 1 if max_delta < 1 << 16 else 2
+        tf_code = 0 if max_tf < 1 << 8 else 1
+        return (
+            bytes([delta_code | tf_code << 2])
+            + deltas.astype(DELTA_DTYPES[delta_code]).tobytes()
+            + tfs.astype(TF_DTYPES[tf_code]).tobytes()
+        )
+
+    def _split_postings(self, blob: bytes) -> Tuple[np.ndarray, np.ndarray]:
+        """バイナリを doc_idの差分配列とtf配列 に分解（コピーなし）"""
+        header = blob[0]
+        delta_dtype = DELTA_DTYPES[header & 3]
+        tf_dtype = TF_DTYPES[header >> 2 & 1]
+        n = (len(blob) - 1) // (delta_dtype.itemsize + tf_dtype.itemsize)
+        deltas = np.frombuffer(blob, dtype=delta_dtype, count=n, offset=1)
+        tfs = np.frombuffer(blob, dtype=tf_dtype, count=n, offset=1 + n * delta_dtype.itemsize)
+        return deltas, tfs
+
+    def _decode_postings(self, blob: bytes) -> Tuple[np.ndarray, np.ndarray]:
+        """バイナリから postings をデコード
+
+        Returns:
+            (doc_id配列 int64, tf配列)
+        """
+        deltas, tfs = self._split_postings(blob)
+        return np.cumsum(deltas, dtype=np.int64), tfs
+
+    def _merge_postings(self, blob: bytes, postings: Dict[int, int]) -> Tuple[int, bytes]:
+        """既存のpostings blobに新しいpostingsをマージ
+
+        追加文書のdoc_idは既存より大きいのが通常のため、その場合は既存の差分列を
+        デコードせずに末尾へ連結する。そうでなければdictでマージし直す。
+
+        Returns:
+            (df, マージ後のblob)
+        """
+        old_deltas, old_tfs = self._split_postings(blob)
+        n = len(postings)
+        doc_ids = np.fromiter(postings.keys(), dtype=np.int64, count=n)
+        tfs = np.fromiter(postings.values(), dtype=np.int64, count=n)
+        last_id = int(old_deltas.sum(dtype=np.int64))
+
+        if len(old_deltas) and doc_ids.min() > last_id:
+            order = np.argsort(doc_ids, kind='stable')
+            deltas = np.concatenate([old_deltas, np.diff(doc_ids[order], prepend=last_id)])
+            return len(deltas), self._encode_deltas(deltas, np.concatenate([old_tfs, tfs[order]]))
+
+        merged = self._postings_dict(blob)
+        merged.update(postings)
+        return len(merged), self._encode_postings(merged)
+
+    def _postings_dict(self, blob: bytes) -> Dict[int, int]:
+        doc_ids, tfs = self._decode_postings(blob)
+        return dict(zip(doc_ids.tolist(), tfs.tolist()))
 
     def tokenize(self, text: str) -> List[str]:
         """日本語テキストをトークン化（単語 + 2-gram）"""
-        words = re.findall(r'[\w\u3040-\u309f\u30a0-\u30ff\u4e00-\u9fff]+', text.lower())
-        tokens = []
-        for word in words:
-            tokens.append(word)
-            if len(word) >= 2:
-                for i in range(len(word) - 1):
-                    tokens.append(word[i:i + 2])
-        return tokens
+        words = TOKEN_PATTERN.findall(text.lower())
+        return words + [w[i:i + 2] for w in words for i in range(len(w) - 1)]
 
     def add(self, texts: List[str]) -> None:
         """テキストを追加（インクリメンタル）"""
@@ -99,11 +196,7 @@ class BM25Indexer:
             tokens = self.tokenize(text)
             doc_lens_data.append((doc_id, len(tokens)))
 
-            term_counts: Dict[str, int] = {}
-            for token in tokens:
-                term_counts[token] = term_counts.get(token, 0) + 1
-
-            for term, tf in term_counts.items():
+            for term, tf in Counter(tokens).items():
                 if term not in term_postings:
                     term_postings[term] = {}
                 term_postings[term][doc_id] = tf
@@ -111,23 +204,23 @@ class BM25Indexer:
         # doc_lens挿入
         cursor.executemany("INSERT INTO doc_lens VALUES (?, ?)", doc_lens_data)
 
-        # terms更新（既存のpostingsとマージ）
-        for term, new_postings in term_postings.items():
-            cursor.execute("SELECT df, postings FROM terms WHERE term = ?", (term,))
-            row = cursor.fetchone()
-
-            if row:
-                old_df, old_blob = row
-                old_postings = dict(self._decode_postings(old_blob))
-                old_postings.update(new_postings)
-                new_df = len(old_postings)
-                new_blob = self._encode_postings(old_postings)
-                cursor.execute("UPDATE terms SET df = ?, postings = ? WHERE term = ?",
-                             (new_df, new_blob, term))
-            else:
-                new_blob = self._encode_postings(new_postings)
-                cursor.execute("INSERT INTO terms VALUES (?, ?, ?)",
-                             (term, len(new_postings), new_blob))
+        # terms更新（既存のpostingsとマージ）: 既存行はまとめてSELECTし、まとめて書き込む
+        terms = list(term_postings)
+        rows: Dict[str, Tuple[int, bytes]] = {}
+        for i in range(0, len(terms), SQL_VARIABLE_LIMIT):
+            chunk = terms[i:i + SQL_VARIABLE_LIMIT]
+            placeholders = ",".join("?" * len(chunk))
+            cursor.execute(f"SELECT term, postings FROM terms WHERE term IN ({placeholders})", chunk)
+            for term, old_blob in cursor.fetchall():
+                rows[term] = self._merge_postings(old_blob, term_postings[term])
+        for term, postings in term_postings.items():
+            if term not in rows:
+                rows[term] = (len(postings), self._encode_postings(postings))
+
+        cursor.executemany(
+            "INSERT OR REPLACE INTO terms VALUES (?, ?, ?)",
+            ((term, df, blob) for term, (df, blob) in rows.items())
+        )
 
         # 統計更新
         cursor.execute("SELECT COUNT(*), SUM(length) FROM doc_lens")
@@ -138,6 +231,7 @@ class BM25Indexer:
         cursor.execute("INSERT OR REPLACE INTO stats VALUES ('avgdl', ?)", (avgdl,))
 
         conn.commit()
+        self._doc_norms = None
         logger.info(f"BM25: {len(texts)}件追加（合計{count}件）")
 
     def search(self, query: str, top_k: int = 10) -> List[Tuple[int, float]]:
@@ -145,47 +239,65 @@ class BM25Indexer:
         conn = self._get_conn()
         cursor = conn.cursor()
 
-        cursor.execute("SELECT value FROM stats WHERE key = 'corpus_size'")
-        row = cursor.fetchone()
-        if not row:
+        cursor.execute("SELECT key, value FROM stats WHERE key IN ('corpus_size', 'avgdl')")
+        stats = dict(cursor.fetchall())
+        if 'corpus_size' not in stats:
             return []
-        corpus_size = int(row[0])
+        corpus_size = int(stats['corpus_size'])
+        avgdl = stats['avgdl']
 
-        cursor.execute("SELECT value FROM stats WHERE key = 'avgdl'")
-        avgdl = cursor.fetchone()[0]
-
-        query_tokens = set(self.tokenize(query))
+        # クエリ内で繰り返される語は出現回数（qtf）で重み付けする
+        query_tf = Counter(self.tokenize(query))
+        query_tokens = list(query_tf)
         if not query_tokens:
             return []
 
-        # doc_lensをキャッシュ（初回のみ）
-        cursor.execute("SELECT doc_id, length FROM doc_lens")
-        doc_lens = {row[0]: row[1] for row in cursor.fetchall()}
+        # クエリ語のpostingsをまとめて取得（語ごとの往復を避ける）
+        rows = []
+        for i in range(0, len(query_tokens), SQL_VARIABLE_LIMIT):
+            chunk = query_tokens[i:i + SQL_VARIABLE_LIMIT]
+            placeholders = ",".join("?" * len(chunk))
+            cursor.execute(
+                f"SELECT term, df, postings FROM terms WHERE term IN ({placeholders}) AND df >= ?",
+                (*chunk, self.min_df)
+            )
+            rows.extend(cursor.fetchall())
+        if not rows:
+            return []
+
+        # IDF × qtf は全語まとめてベクトル計算
+        dfs = np.fromiter((df for _, df, _ in rows), dtype=np.float64, count=len(rows))
+        qtfs = np.fromiter((query_tf[term] for term, _, _ in rows), dtype=np.float64, count=len(rows))
+        weights = qtfs * np.log((corpus_size - dfs + 0.5) / (dfs + 0.5) + 1)
 
-        scores: Dict[int, float] = {}
+        norm = self._get_doc_norms(avgdl)
+        scores = np.zeros(len(norm), dtype=np.float64)
 
-        for token in query_tokens:
-            cursor.execute("SELECT df, postings FROM terms WHERE term = ?", (token,))
-            row = cursor.fetchone()
-            if not row:
-                continue
+        for weight, (_, _, blob) in zip(weights.tolist(), rows):
+            doc_ids, tfs = self._decode_postings(blob)
+            tfs = tfs.astype(np.float64)
 
-            df, blob = row
-            if df < self.min_df:
-                continue
+            # 1つのpostings内でdoc_idは重複しないため、ファンシーインデックスで加算できる
+            scores[doc_ids] += weight * tfs * (self.k1 + 1) / (tfs + norm[doc_ids])
 
-            idf = math.log((corpus_size - df + 0.5) / (df + 0.5) + 1)
-            postings = self._decode_postings(blob)
+        matched = np.flatnonzero(scores)
+        if len(matched) > top_k:
+            matched = matched[np.argpartition(scores[matched], -top_k)[-top_k:]]
+        top = matched[np.argsort(-scores[matched], kind='stable')]
+        return list(zip(top.tolist(), scores[top].tolist()))
 
-            for doc_id, tf in postings:
-                doc_len = doc_lens.get(doc_id, avgdl)
-                term_score = idf * tf * (self.k1 + 1) / (
-                    tf + self.k1 * (1 - self.b + self.b * doc_len / avgdl)
-                )
-                scores[doc_id] = scores.get(doc_id, 0) + term_score
+    def _get_doc_norms(self, avgdl: float) -> np.ndarray:
+        """doc_id -> k1 * (1 - b + b * 文書長 / avgdl) の密な配列
 
-        sorted_scores = sorted(scores.items(), key=lambda x: x[1], reverse=True)
-        return sorted_scores[:top_k]
+        正規化項はクエリによらないため、初回のみDBから文書長を読んで計算し保持する。
+        """
+        if self._doc_norms is None:
+            rows = self._get_conn().execute("SELECT doc_id, length FROM doc_lens").fetchall()
+            ids = np.fromiter((r[0] for r in rows), dtype=np.int64, count=len(rows))
+            lens = np.full(int(ids.max()) + 1 if len(ids) else 0, avgdl, dtype=np.float64)
+            lens[ids] = np.fromiter((r[1] for r in rows), dtype=np.float64, count=len(rows))
+            self._doc_norms = self.k1 * (1 - self.b + self.b * lens / avgdl)
+        return self._doc_norms
 
     @property
     def corpus_size(self) -> int:
@@ -218,53 +330,53 @@ class BM25Indexer:
 
     def _migrate_from_json(self, json_path: Path) -> None:
         """旧JSONからSQLiteへ移行（効率的なスキーマ + 語彙削減）"""
-        import json
-
         logger.info("JSON読み込み中...")
-        data = json.loads(json_path.read_text(encoding='utf-8'))
+        data = orjson.loads(json_path.read_bytes())
 
         conn = self._get_conn()
         cursor = conn.cursor()
-
-        # doc_lens
-        logger.info("doc_lens移行中...")
-        doc_lens_data = [(i, length) for i, length in enumerate(data["doc_lens"])]
-        cursor.executemany("INSERT INTO doc_lens VALUES (?, ?)", doc_lens_data)
-        conn.commit()
-
-        # terms（語彙削減 + バイナリ圧縮）
-        logger.info("転置インデックス移行中（語彙削減適用）...")
-        inverted = data["inverted_index"]
-        total_terms = len(inverted)
-        kept_terms = 0
-        batch = []
-
-        for i, (term, postings) in enumerate(inverted.items()):
-            df = len(postings)
-            # 低頻度語を削除（min_df未満）
-            if df < self.min_df:
-                continue
-
-            postings_dict = {int(doc_id): tf for doc_id, tf in postings.items()}
-            blob = self._encode_postings(postings_dict)
-            batch.append((term, df, blob))
-            kept_terms += 1
-
-            if len(batch) >= 10000:
-                cursor.executemany("INSERT INTO terms VALUES (?, ?, ?)", batch)
-                conn.commit()
+        # 移行は1トランザクションで行い、途中のfsyncを省く（失敗時はロールバックされる）
+        conn.execute("PRAGMA synchronous=OFF")
+        try:
+            with conn:
+                # doc_lens
+                logger.info("doc_lens移行中...")
+                doc_lens_data = [(i, length) for i, length in enumerate(data["doc_lens"])]
+                cursor.executemany("INSERT INTO doc_lens VALUES (?, ?)", doc_lens_data)
+
+                # terms（語彙削減 + バイナリ圧縮）
+                logger.info("転置インデックス移行中（語彙削減適用）...")
+                inverted = data["inverted_index"]
+                total_terms = len(inverted)
+                kept_terms = 0
                 batch = []
-                if kept_terms % 100000 == 0:
-                    logger.info(f"  {kept_terms:,}語処理済み...")
 
-        if batch:
-            cursor.executemany("INSERT INTO terms VALUES (?, ?, ?)", batch)
-
-        # 統計
-        cursor.execute("INSERT OR REPLACE INTO stats VALUES ('corpus_size', ?)", (data["corpus_size"],))
-        cursor.execute("INSERT OR REPLACE INTO stats VALUES ('avgdl', ?)", (data["avgdl"],))
-        conn.commit()
+                for term, postings in inverted.items():
+                    df = len(postings)
+                    # 低頻度語を削除（min_df未満）
+                    if df < self.min_df:
+                        continue
+
+                    postings_dict = {int(doc_id): tf for doc_id, tf in postings.items()}
+                    batch.append((term, df, self._encode_postings(postings_dict)))
+                    kept_terms += 1
+
+                    if len(batch) >= 10000:
+                        cursor.executemany("INSERT INTO terms VALUES (?, ?, ?)", batch)
+                        batch = []
+                        if kept_terms % 100000 == 0:
+                            logger.info(f"  {kept_terms:,}語処理済み...")
+
+                if batch:
+                    cursor.executemany("INSERT INTO terms VALUES (?, ?, ?)", batch)
+
+                # 統計
+                cursor.execute("INSERT OR REPLACE INTO stats VALUES ('corpus_size', ?)", (data["corpus_size"],))
+                cursor.execute("INSERT OR REPLACE INTO stats VALUES ('avgdl', ?)", (data["avgdl"],))
+        finally:
+            conn.execute("PRAGMA synchronous=NORMAL")
         conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        self._doc_norms = None
 
         # 旧ファイルをリネーム
         json_path.rename(json_path.with_suffix('.json.old'))
@@ -2,6 +2,8 @@
 
 import click
 import requests
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 
 API_URL = "http://localhost:8000"
@@ -18,6 +20,42 @@ def print_results(results: list) -> None:
         click.echo()
 
 
+def wait_job(api_url: str, job_id: str, interval: float = 1.0) -> dict:
+    """アップロードジョブの完了を待つ"""
+    while True:
+        resp = requests.get(f"{api_url}/jobs/{job_id}")
+        resp.raise_for_status()
+        job = resp.json()
+        if job["status"] in ("done", "error"):
+            return job
+        time.sleep(interval)
+
+
+def upload_file(api_url: str, path: Path, wait: bool) -> tuple:
+    """PDFを1件アップロードし、(表示メッセージ, エラーか) を返す"""
+    try:
+        with open(path, 'rb') as fp:
+            resp = requests.post(
+                f"{api_url}/upload",
+                files={'file': (path.name, fp, 'application/pdf')}
+            )
+
+        if resp.status_code == 400 and "処理済み" in resp.text:
+            return f"スキップ: {path.name}", False
+        resp.raise_for_status()
+        job_id = resp.json()["job_id"]
+        if not wait:
+            return f"受付: {path.name} (job: {job_id})", False
+
+        job = wait_job(api_url, job_id)
+        if job["status"] == "done":
+            return f"完了: {path.name} ({job['texts_count']}ページ)", False
+        return f"エラー: {path.name} - {job['message']}", True
+
+    except requests.RequestException as e:
+        return f"エラー: {path.name} - {e}", True
+
+
 @click.group()
 @click.option('--api-url', default=API_URL, envvar='KUGUTSUSHI_API_URL', help='APIサーバーURL')
 @click.pass_context
@@ -50,8 +88,11 @@ def search(ctx, query: str, top_k: int, mode: str):
 @cli.command()
 @click.argument('path', type=click.Path(exists=True))
 @click.option('--recursive', '-r', is_flag=True, help='サブディレクトリも処理')
+@click.option('--wait', '-w', is_flag=True, help='各ファイルの処理完了を待つ')
+@click.option('--parallel', '-p', default=4, envvar='KUGUTSUSHI_UPLOAD_PARALLEL',
+              type=click.IntRange(min=1), help='同時アップロード数')
 @click.pass_context
-def upload(ctx, path: str, recursive: bool):
+def upload(ctx, path: str, recursive: bool, wait: bool, parallel: int):
     """PDFをアップロード"""
     path = Path(path)
     if path.is_file():
@@ -66,23 +107,30 @@ def upload(ctx, path: str, recursive: bool):
 
     click.echo(f"{len(files)}個のPDFを処理します...")
 
-    for i, f in enumerate(files, 1):
-        try:
-            with open(f, 'rb') as fp:
-                resp = requests.post(
-                    f"{ctx.obj['api_url']}/upload",
-                    files={'file': (f.name, fp, 'application/pdf')}
-                )
-
-            if resp.status_code == 400 and "処理済み" in resp.text:
-                click.echo(f"[{i}/{len(files)}] スキップ: {f.name}")
-            else:
-                resp.raise_for_status()
-                result = resp.json()
-                click.echo(f"[{i}/{len(files)}] 完了: {f.name} ({result['texts_count']}ページ)")
-
-        except requests.RequestException as e:
-            click.echo(f"[{i}/{len(files)}] エラー: {f.name} - {e}", err=True)
+    # 送信と完了待ちを並行させる（サーバー側の処理は1件ずつ順に行われる）
+    with ThreadPoolExecutor(max_workers=parallel) as executor:
+        futures = [executor.submit(upload_file, ctx.obj['api_url'], f, wait) for f in files]
+        for i, future in enumerate(as_completed(futures), 1):
+            message, is_error = future.result()
+            click.echo(f"[{i}/{len(files)}] {message}", err=is_error)
+
+
+@cli.command()
+@click.argument('job_id')
+@click.pass_context
+def job(ctx, job_id: str):
+    """アップロードジョブの状態を表示"""
+    try:
+        resp = requests.get(f"{ctx.obj['api_url']}/jobs/{job_id}")
+        resp.raise_for_status()
+        data = resp.json()
+
+        click.echo(f"{data['filename']}: {data['status']}")
+        if data.get("message"):
+            click.echo(f"詳細: {data['message']}")
+
+    except requests.RequestException as e:
+        click.echo(f"エラー: {e}", err=True)
 
 
 @cli.command()
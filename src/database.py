@@ -1,13 +1,24 @@
 """メタデータ管理 - SQLiteによるテキスト・ファイル情報の永続化"""
 
 import sqlite3
+from functools import lru_cache
 from pathlib import Path
 import logging
+import threading
 from typing import List, Dict
 import unicodedata
 
 logger = logging.getLogger(__name__)
 
+SCHEMA_VERSION = 1  # 1: fileカラムをNFC正規化して保存
+METADATA_CHUNK_SIZE = 500  # get_metadataで1回に問い合わせるID数（SQL変数の上限対策）
+
+
+@lru_cache(maxsize=4096)
+def _nfc(text: str) -> str:
+    """Unicode正規化（NFC形式に統一、同じファイル名は再計算しない）"""
+    return unicodedata.normalize('NFC', text)
+
 
 class Database:
     """SQLiteによるメタデータ管理
@@ -15,11 +26,14 @@ class Database:
     スキーマ:
         id: INTEGER PRIMARY KEY（ベクトルインデックスと対応）
         text: TEXT（ページ本文）
-        file: TEXT（PDFファイル名）
+        file: TEXT（PDFファイル名、NFC正規化済み）
         page: INTEGER（ページ番号、0-indexed）
 
     注意: add_metadata()はバッファに追加するだけで、flush()を呼ぶまでDBに保存されない。
     これによりベクトルとメタデータの整合性を保つ。
+
+    接続は1本をキャッシュして使い回す（WAL + mmap）。APIではスレッドから呼ばれるため、
+    接続の利用はロックで直列化する。
     """
 
     def __init__(self, db_path: str = "embeddings/metadata.db"):
@@ -27,11 +41,38 @@ class Database:
         self.db_path.parent.mkdir(exist_ok=True)
         self._buffer = []  # メタデータバッファ
         self._buffer_start_id = 0
+        self._conn = None
+        self._lock = threading.RLock()
         self._init_db()
 
+    def _get_conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute("PRAGMA temp_store=MEMORY")
+            self._conn.execute("PRAGMA mmap_size=268435456")  # 256MB
+            self._conn.execute("PRAGMA cache_size=-65536")  # 64MB
+            self._conn.execute("PRAGMA busy_timeout=60000")
+        return self._conn
+
+    def checkpoint(self) -> None:
+        """WALの内容を本体ファイルに書き戻す（metadata.db単体をコピーしても完全になるように）"""
+        with self._lock:
+            self._get_conn().execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    def close(self) -> None:
+        """WALをチェックポイントして接続を閉じる"""
+        with self._lock:
+            if self._conn is None:
+                return
+            self.checkpoint()
+            self._conn.close()
+            self._conn = None
+
     def _init_db(self) -> None:
         """データベースとテーブルの初期化"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self._lock, self._get_conn() as conn:
             conn.execute("""
                 CREATE TABLE IF NOT EXISTS metadata (
                     id INTEGER PRIMARY KEY,
@@ -42,10 +83,21 @@ class Database:
             """)
             conn.execute("CREATE INDEX IF NOT EXISTS idx_file_page ON metadata(file, page)")
 
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            if version < 1:
+                # 旧形式のDBはNFDなど正規化前のファイル名を含みうるため、一括でNFCに揃える
+                conn.create_function("nfc", 1, _nfc, deterministic=True)
+                updated = conn.execute("UPDATE metadata SET file = nfc(file) WHERE file != nfc(file)").rowcount
+                if updated:
+                    logger.info(f"ファイル名をNFC正規化: {updated}件")
+            conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
     def clear(self) -> None:
         """全データの削除"""
-        with sqlite3.connect(self.db_path) as conn:
-            conn.execute("DELETE FROM metadata")
+        with self._lock:
+            conn = self._get_conn()
+            with conn:
+                conn.execute("DELETE FROM metadata")
             conn.execute("VACUUM")
 
     def add_metadata(self, metadata_list: List[Dict], start_id: int = 0) -> int:
@@ -59,10 +111,10 @@ class Database:
         """バッファをDBに書き込み"""
         if not self._buffer:
             return 0
-        with sqlite3.connect(self.db_path) as conn:
+        with self._lock, self._get_conn() as conn:
             conn.executemany(
                 "INSERT INTO metadata (id, text, file, page) VALUES (?, ?, ?, ?)",
-                [(self._buffer_start_id + i, m["text"], m["file"], m["page"]) for i, m in enumerate(self._buffer)]
+                [(self._buffer_start_id + i, m["text"], _nfc(m["file"]), m["page"]) for i, m in enumerate(self._buffer)]
             )
         count = len(self._buffer)
         self._buffer = []
@@ -73,71 +125,77 @@ class Database:
         """IDリストに対応するメタデータを取得（順序維持）"""
         if not ids:
             return []
-        with sqlite3.connect(self.db_path) as conn:
-            placeholders = ",".join("?" * len(ids))
-            query = f"SELECT id, text, file, page FROM metadata WHERE id IN ({placeholders})"
-            cursor = conn.execute(query, ids)
-            rows = {row[0]: {"text": row[1], "file": row[2], "page": row[3]} for row in cursor.fetchall()}
-            return [rows.get(i, {}) for i in ids if i in rows]
+        results = []
+        with self._lock:
+            conn = self._get_conn()
+            # 要求順の位置をVALUESで渡し、JOIN + ORDER BYで並び替えまでSQLiteに任せる
+            for start in range(0, len(ids), METADATA_CHUNK_SIZE):
+                chunk = ids[start:start + METADATA_CHUNK_SIZE]
+                values = ",".join(f"({pos},?)" for pos in range(len(chunk)))
+                cursor = conn.execute(
+                    f"WITH v(pos, id) AS (VALUES {values}) "
+                    "SELECT m.text, m.file, m.page FROM v JOIN metadata m ON m.id = v.id ORDER BY v.pos",
+                    chunk
+                )
+                results.extend({"text": row[0], "file": row[1], "page": row[2]} for row in cursor)
+        return results
+
+    def get_metadata_map(self, ids: List[int]) -> Dict[int, Dict]:
+        """IDリストに対応するメタデータを {id: メタデータ} で取得（存在しないIDは含まない）"""
+        rows = {}
+        with self._lock:
+            conn = self._get_conn()
+            for start in range(0, len(ids), METADATA_CHUNK_SIZE):
+                chunk = ids[start:start + METADATA_CHUNK_SIZE]
+                placeholders = ",".join("?" * len(chunk))
+                cursor = conn.execute(
+                    f"SELECT id, text, file, page FROM metadata WHERE id IN ({placeholders})", chunk
+                )
+                rows.update((row[0], {"text": row[1], "file": row[2], "page": row[3]}) for row in cursor)
+        return rows
 
     def get_all_metadata(self) -> List[Dict]:
         """全メタデータを取得（ID順）"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self._lock:
+            conn = self._get_conn()
             cursor = conn.execute("SELECT text, file, page FROM metadata ORDER BY id")
             return [{"text": row[0], "file": row[1], "page": row[2]} for row in cursor.fetchall()]
 
     def get_all_texts(self) -> List[str]:
         """全テキストをID順で取得（BM25用）"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self._lock:
+            conn = self._get_conn()
             cursor = conn.execute("SELECT text FROM metadata ORDER BY id")
             return [row[0] for row in cursor.fetchall()]
 
     def get_metadata_count(self) -> int:
         """メタデータの総数を取得（バッファ含む）"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self._lock:
+            conn = self._get_conn()
             cursor = conn.execute("SELECT COUNT(*) FROM metadata")
             db_count = cursor.fetchone()[0]
         return db_count + len(self._buffer)
 
     def _normalize(self, text: str) -> str:
         """Unicode正規化（NFC形式に統一）"""
-        return unicodedata.normalize('NFC', text)
+        return _nfc(text)
 
     def get_file_list(self) -> List[str]:
         """登録されているファイル一覧を取得（NFC正規化済み）"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self._lock:
+            conn = self._get_conn()
             cursor = conn.execute("SELECT DISTINCT file FROM metadata")
-            return [self._normalize(row[0]) for row in cursor.fetchall()]
+            return [row[0] for row in cursor.fetchall()]
 
     def get_metadata_by_file(self, filename: str) -> List[Dict]:
         """特定ファイルのメタデータをページ順で取得
 
-        ファイル名はNFC/NFD両形式で検索し、Unicode正規化の違いを吸収する
+        ファイル名は保存時と同じくNFC正規化して検索し、Unicode正規化の違いを吸収する
         """
-        normalized = self._normalize(filename)
-        with sqlite3.connect(self.db_path) as conn:
-            # まずNFC正規化した名前で検索
+        with self._lock:
+            conn = self._get_conn()
             cursor = conn.execute(
                 "SELECT text, page FROM metadata WHERE file = ? ORDER BY page, id",
-                (normalized,)
+                (self._normalize(filename),)
             )
-            results = cursor.fetchall()
-
-            # 見つからなければNFD形式でも試す
-            if not results:
-                nfd = unicodedata.normalize('NFD', filename)
-                cursor = conn.execute(
-                    "SELECT text, page FROM metadata WHERE file = ? ORDER BY page, id",
-                    (nfd,)
-                )
-                results = cursor.fetchall()
-
-            # それでも見つからなければ元の形式で試す
-            if not results:
-                cursor = conn.execute(
-                    "SELECT text, page FROM metadata WHERE file = ? ORDER BY page, id",
-                    (filename,)
-                )
-                results = cursor.fetchall()
-
-            return [{"text": row[0], "page": row[1]} for row in results]
+            return [{"text": row[0], "page": row[1]} for row in cursor.fetchall()]
@@ -1,43 +1,124 @@
 """埋め込み生成 - Ruri v3による日本語テキストのベクトル化"""
 
-from typing import List, Dict
+from functools import lru_cache
+from typing import List, Optional, Union
+import os
 import numpy as np
+import torch
 from sentence_transformers import SentenceTransformer
 
+from .embedding_cache import EmbeddingCache
+
+MODEL_NAME = "cl-nagoya/ruri-v3-130m"
+# 前処理（プレフィックス・正規化等）を変えたら上げる。キャッシュの指紋に含まれる
+EMBEDDING_VERSION = 2
+MODEL_FINGERPRINT = f"{MODEL_NAME}@v{EMBEDDING_VERSION}"
+
 # Ruri v3のプレフィックス（公式推奨）
 QUERY_PREFIX = "検索クエリ: "
 DOCUMENT_PREFIX = "検索文書: "
 
 
+def resolve_device(device: Optional[str] = None) -> str:
+    """推論デバイスを決定
+
+    明示指定 > 環境変数KUGUTSUSHI_DEVICE > CUDAがあればcuda > cpu
+    """
+    device = device or os.environ.get("KUGUTSUSHI_DEVICE")
+    if device:
+        return device
+    return "cuda" if torch.cuda.is_available() else "cpu"
+
+
+@lru_cache(maxsize=2)
+def load_model(model_name: str, device: str, quantize: bool = False) -> SentenceTransformer:
+    """モデルを読み込む（同じ設定はプロセス内で1回だけ読み込み、共有する）
+
+    quantize=TrueならCPU推論用にLinear層をint8動的量子化する（GPUでは無視）。
+    """
+    model = SentenceTransformer(model_name, device=device)
+    if device == "cuda":
+        model.half()  # GPUではfp16で推論（出力は_encodeでfloat32に戻す）
+    elif quantize:
+        # auto_modelは新しいsentence-transformersでは読み取り専用のため、その場で置き換える
+        torch.ao.quantization.quantize_dynamic(
+            model[0].auto_model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True
+        )
+    return model
+
+
 class Embedder:
     """Ruri v3-130mによる埋め込み生成器
 
     512次元のベクトルを生成。クエリとドキュメントで異なるプレフィックスを使用。
+    出力は生成時にL2正規化済み（内積 = コサイン類似度。Indexerでは正規化しない）。
+    query_cache / document_cacheを渡すと、計算済みのベクトルをキャッシュから再利用する。
+    quantize（既定は環境変数KUGUTSUSHI_QUANTIZE=1）でCPU推論をint8化する。
+    int8・fp16（GPU）では値がわずかに変わるため、キャッシュにはfingerprintを使う。
     """
 
-    def __init__(self, device: str = "cpu"):
-        self.model = SentenceTransformer("cl-nagoya/ruri-v3-130m", device=device)
+    def __init__(
+        self,
+        device: Optional[str] = None,
+        query_cache: Optional[EmbeddingCache] = None,
+        document_cache: Optional[EmbeddingCache] = None,
+        quantize: Optional[bool] = None
+    ):
+        self.device = resolve_device(device)
+        if quantize is None:
+            quantize = os.environ.get("KUGUTSUSHI_QUANTIZE") == "1"
+        self.quantize = quantize and self.device == "cpu"
+        # 推論精度で値がわずかに変わるため、キャッシュのキーを分ける
+        if self.device == "cuda":
+            self.fingerprint = MODEL_FINGERPRINT + "+fp16"
+        elif self.quantize:
+            self.fingerprint = MODEL_FINGERPRINT + "+int8"
+        else:
+            self.fingerprint = MODEL_FINGERPRINT
+        self.model = load_model(MODEL_NAME, self.device, self.quantize)
         self.dimension = 512
+        self.query_cache = query_cache
+        self.document_cache = document_cache
 
     def generate_query_embedding(self, query: str) -> np.ndarray:
         """検索クエリをベクトル化"""
-        return self.model.encode(QUERY_PREFIX + query)
+        text = QUERY_PREFIX + query
+        if self.query_cache is not None:
+            return self.query_cache.get_or_compute(text, self._encode)
+        return self._encode(text)
+
+    def generate_query_embeddings(self, queries: List[str]) -> np.ndarray:
+        """複数の検索クエリを一括ベクトル化
+
+        キャッシュにないクエリだけを1回のencodeでまとめて処理する。
+        """
+        texts = [QUERY_PREFIX + q for q in queries]
+        if self.query_cache is not None:
+            return self.query_cache.get_or_compute_many(texts, self._encode_queries)
+        return self._encode_queries(texts)
+
+    def _encode_queries(self, texts: List[str]) -> np.ndarray:
+        return self._encode(texts, batch_size=len(texts))
+
+    def _encode(self, texts: Union[str, List[str]], batch_size: int = 32) -> np.ndarray:
+        vectors = self.model.encode(
+            texts, batch_size=batch_size, normalize_embeddings=True, show_progress_bar=False
+        )
+        return vectors.astype(np.float32, copy=False)
 
     def generate_document_embedding(self, text: str) -> np.ndarray:
         """単一ドキュメントをベクトル化"""
-        return self.model.encode(DOCUMENT_PREFIX + text)
-
-    def generate_document_embeddings(self, texts: List[str]) -> np.ndarray:
-        """複数ドキュメントを一括ベクトル化（効率的）"""
-        prefixed = [DOCUMENT_PREFIX + t for t in texts]
-        return self.model.encode(prefixed)
+        return self._encode(DOCUMENT_PREFIX + text)
 
-    # 以下はbatch_index.pyとの互換性のためのエイリアス
-    def generate_embedding(self, text: str) -> np.ndarray:
-        """テキストをベクトル化（ドキュメントとして扱う）"""
-        return self.generate_document_embedding(text)
+    def generate_document_embeddings(self, texts: List[str], batch_size: int = 32) -> np.ndarray:
+        """複数ドキュメントを一括ベクトル化（効率的）
 
-    def generate_embeddings(self, texts: List[Dict]) -> np.ndarray:
-        """複数テキストを一括ベクトル化（Dict形式入力）"""
-        text_list = [t["text"] for t in texts]
-        return self.generate_document_embeddings(text_list)
+        batch_size件ずつまとめてモデルに渡し、1回のforwardで処理する。
+        document_cacheがあれば、キャッシュにない文書だけをモデルに渡す。
+        """
+        prefixed = [DOCUMENT_PREFIX + t for t in texts]
+        if self.document_cache is not None:
+            return self.document_cache.get_or_compute_many(
+                prefixed, lambda missing: self._encode(missing, batch_size=batch_size)
+            )
+        return self._encode(prefixed, batch_size=batch_size)
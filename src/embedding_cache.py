@@ -0,0 +1,156 @@
+"""埋め込みキャッシュ - テキスト内容をキーにしたベクトルの永続化"""
+
+from typing import Callable, List, Optional
+from pathlib import Path
+import hashlib
+import sqlite3
+import logging
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+SQL_VARIABLE_LIMIT = 900  # 1文あたりのプレースホルダ数（SQLiteの上限999未満）
+
+
+class EmbeddingCache:
+    """SQLiteベースの内容アドレス型埋め込みキャッシュ
+
+    キー: blake2b(モデル指紋 + 保存形式 + テキスト)
+    値: float32ベクトル、half=True時はfloat16ベクトル、
+        quantize=True時は スケール(float32) + int8ベクトル のバイト列
+    用途: 評価・APIのクエリキャッシュ、バッチインデクシングの文書キャッシュ（再インデックス時の再計算を省く）
+
+    モデル指紋をキーに含めるため、モデルや前処理を変更すると自動的に別エントリになる。
+    int8量子化はサイズが1/4になる代わりに値が近似になる（評価用クエリキャッシュ向け）。
+    float16はサイズが1/2で、正規化済みベクトルの順位はほぼ変わらない（文書キャッシュ向け）。
+    """
+
+    def __init__(
+        self,
+        db_path: str = "embeddings/query_cache.db",
+        fingerprint: str = "",
+        quantize: bool = False,
+        half: bool = False
+    ):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(exist_ok=True)
+        self.fingerprint = fingerprint
+        self.quantize = quantize
+        self.half = half and not quantize
+        self.hits = 0
+        self.misses = 0
+        self._conn = None
+        self._init_db()
+
+    def _get_conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+        return self._conn
+
+    def _init_db(self) -> None:
+        conn = self._get_conn()
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS embeddings (
+                key BLOB PRIMARY KEY,
+                vector BLOB NOT NULL
+            )
+        """)
+        conn.commit()
+
+    def _key(self, text: str) -> bytes:
+        h = hashlib.blake2b(digest_size=16)
+        h.update(self.fingerprint.encode('utf-8'))
+        h.update(b"\0int8\0" if self.quantize else b"\0fp16\0" if self.half else b"\0")
+        h.update(text.encode('utf-8'))
+        return h.digest()
+
+    def _encode(self, vector: np.ndarray) -> bytes:
+        vector = np.asarray(vector, dtype=np.float32)
+        if self.half:
+            return vector.astype(np.float16).tobytes()
+        if not self.quantize:
+            return vector.tobytes()
+        scale = float(np.abs(vector).max()) / 127 or 1.0
+        codes = np.round(vector / scale).astype(np.int8)
+        return np.float32(scale).tobytes() + codes.tobytes()
+
+    def _decode(self, blob: bytes) -> np.ndarray:
+        if self.half:
+            return np.frombuffer(blob, dtype=np.float16).astype(np.float32)
+        if not self.quantize:
+            return np.frombuffer(blob, dtype=np.float32).copy()
+        scale = np.frombuffer(blob, dtype=np.float32, count=1)[0]
+        return np.frombuffer(blob, dtype=np.int8, offset=4).astype(np.float32) * scale
+
+    def get(self, text: str) -> Optional[np.ndarray]:
+        """キャッシュからベクトルを取得（なければNone）"""
+        row = self._get_conn().execute(
+            "SELECT vector FROM embeddings WHERE key = ?", (self._key(text),)
+        ).fetchone()
+        if row is None:
+            return None
+        return self._decode(row[0])
+
+    def put(self, text: str, vector: np.ndarray) -> bytes:
+        """ベクトルをキャッシュに保存（保存したバイト列を返す）"""
+        blob = self._encode(vector)
+        conn = self._get_conn()
+        conn.execute("INSERT OR REPLACE INTO embeddings VALUES (?, ?)", (self._key(text), blob))
+        conn.commit()
+        return blob
+
+    def get_or_compute(self, text: str, compute: Callable[[str], np.ndarray]) -> np.ndarray:
+        """キャッシュにあれば返し、なければ計算して保存"""
+        vector = self.get(text)
+        if vector is not None:
+            self.hits += 1
+            return vector
+        self.misses += 1
+        # 量子化時もヒット時と同じ値を返すよう、保存した表現から復元する
+        return self._decode(self.put(text, compute(text)))
+
+    def get_many(self, texts: List[str]) -> List[Optional[np.ndarray]]:
+        """複数テキストのベクトルをまとめて取得（なければNone）"""
+        keys = [self._key(t) for t in texts]
+        found = {}
+        conn = self._get_conn()
+        unique = list(set(keys))
+        for i in range(0, len(unique), SQL_VARIABLE_LIMIT):
+            chunk = unique[i:i + SQL_VARIABLE_LIMIT]
+            placeholders = ",".join("?" * len(chunk))
+            found.update(conn.execute(
+                f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", chunk
+            ).fetchall())
+        return [self._decode(found[k]) if k in found else None for k in keys]
+
+    def put_many(self, texts: List[str], vectors: np.ndarray) -> List[bytes]:
+        """複数のベクトルを1トランザクションで保存（保存したバイト列を返す）"""
+        blobs = [self._encode(v) for v in vectors]
+        with self._get_conn() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO embeddings VALUES (?, ?)",
+                zip((self._key(t) for t in texts), blobs)
+            )
+        return blobs
+
+    def get_or_compute_many(
+        self,
+        texts: List[str],
+        compute: Callable[[List[str]], np.ndarray]
+    ) -> np.ndarray:
+        """複数テキスト版get_or_compute（ミスした分だけ1回のcomputeでまとめて計算）"""
+        vectors = self.get_many(texts)
+        missing = [i for i, v in enumerate(vectors) if v is None]
+        self.hits += len(texts) - len(missing)
+        self.misses += len(missing)
+        if missing:
+            missing_texts = [texts[i] for i in missing]
+            blobs = self.put_many(missing_texts, compute(missing_texts))
+            for i, blob in zip(missing, blobs):
+                vectors[i] = self._decode(blob)
+        return np.stack(vectors)
+
+    def __len__(self) -> int:
+        return self._get_conn().execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
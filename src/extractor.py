@@ -1,16 +1,32 @@
 """PDF抽出 - PyMuPDFによるテキスト抽出"""
 
 import fitz
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from typing import List, Dict, Union
-import io
+from typing import List, Dict, Optional, Union
+import atexit
+import multiprocessing
+import os
 import re
+import threading
 import logging
 
 logger = logging.getLogger(__name__)
 
 CHUNK_SIZE = 500  # 文字数
 CHUNK_OVERLAP = 50  # オーバーラップ
+# ページ抽出のプロセス数（1なら現在のプロセスで順に抽出）
+EXTRACT_WORKERS = int(os.environ.get("KUGUTSUSHI_EXTRACT_WORKERS", "1"))
+PARALLEL_MIN_PAGES = 64  # これ未満のPDFはプロセス起動のコストが上回るため並列化しない
+
+# 抽出用のプロセスプール（最初の並列抽出で作り、以降のPDFで使い回す）
+_executor: Optional[ProcessPoolExecutor] = None
+_executor_workers = 0
+_executor_lock = threading.Lock()
+
+SENTENCE_END_PATTERN = re.compile(r'(?<=[。．！？\n])')
+WHITESPACE_PATTERN = re.compile(r'\s+')
+KUTEN_NEWLINE = str.maketrans({'。': '。\n'})  # 句点の後に改行を入れる
 
 
 def chunk_text(text: str, chunk_size: int = CHUNK_SIZE, overlap: int = CHUNK_OVERLAP) -> List[str]:
@@ -23,58 +39,118 @@ def chunk_text(text: str, chunk_size: int = CHUNK_SIZE, overlap: int = CHUNK_OVE
         return [text]
 
     # 句点・改行で分割
-    sentences = re.split(r'(?<=[。．！？\n])', text)
+    sentences = SENTENCE_END_PATTERN.split(text)
 
+    # 文字列を連結せず、textの範囲（start, end）だけを追跡して最後にスライスする
     chunks = []
-    current = ""
+    current_start = current_end = 0  # 作成中のチャンクの範囲（空ならstart == end）
+    pos = 0
 
     for sent in sentences:
+        start, end = pos, pos + len(sent)
+        pos = end
+
         # 文自体がchunk_sizeより長い場合は強制分割
-        while len(sent) > chunk_size:
-            if current:
-                chunks.append(current.strip())
-                current = ""
-            chunks.append(sent[:chunk_size].strip())
-            sent = sent[chunk_size - overlap:]
-
-        if len(current) + len(sent) <= chunk_size:
-            current += sent
+        while end - start > chunk_size:
+            if current_end > current_start:
+                chunks.append(text[current_start:current_end].strip())
+                current_start = current_end
+            chunks.append(text[start:start + chunk_size].strip())
+            start += chunk_size - overlap
+
+        if current_end == current_start:
+            current_start, current_end = start, end
+        elif (current_end - current_start) + (end - start) <= chunk_size:
+            current_end = end
         else:
-            if current:
-                chunks.append(current.strip())
-            current = sent
+            chunks.append(text[current_start:current_end].strip())
+            current_start, current_end = start, end
 
-    if current.strip():
-        chunks.append(current.strip())
+    last = text[current_start:current_end].strip()
+    if last:
+        chunks.append(last)
 
     return chunks
 
 
-def extract_from_pdf(pdf_data: Union[str, bytes, Path]) -> List[Dict]:
+def _open_pdf(pdf_data: Union[str, bytes, Path]) -> fitz.Document:
+    if isinstance(pdf_data, (str, Path)):
+        return fitz.open(str(pdf_data))
+    # BytesIOで包むとPyMuPDF内部でgetvalue()のコピーが発生するため、bytesをそのまま渡す
+    return fitz.open(stream=pdf_data, filetype="pdf")
+
+
+def _extract_pages(doc: fitz.Document, page_indices: range) -> List[Dict]:
+    pages = []
+    for i in page_indices:
+        text = doc[i].get_text()
+        if text and text.strip():
+            # テキスト整形: 連続空白を1つに、句点で改行
+            text = WHITESPACE_PATTERN.sub(' ', text).translate(KUTEN_NEWLINE)
+            pages.append({"page": i + 1, "text": text.strip()})
+    return pages
+
+
+def _extract_block(pdf_data: Union[str, bytes, Path], page_indices: range) -> List[Dict]:
+    """ワーカープロセス用: PDFを自分で開き、担当範囲のページだけ抽出"""
+    with _open_pdf(pdf_data) as doc:
+        return _extract_pages(doc, page_indices)
+
+
+def _get_executor(workers: int) -> ProcessPoolExecutor:
+    """抽出用のプロセスプールを返す（なければ作る）
+
+    spawnの子プロセスは起動時に親の__main__を読み込み直すため、
+    batch_index.pyから使うとtorch等のimportでプロセスごとに数秒かかる。PDFごとに作り直さない。
+    """
+    global _executor, _executor_workers
+    with _executor_lock:
+        if _executor is None or _executor_workers != workers:
+            if _executor is not None:
+                _executor.shutdown()
+            # torch等のスレッドを抱えたプロセスをforkしないようspawnで起動する
+            _executor = ProcessPoolExecutor(
+                max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+            )
+            _executor_workers = workers
+        return _executor
+
+
+def shutdown_executor() -> None:
+    """抽出用のプロセスプールを終了する（終了時に自動で呼ばれる）"""
+    global _executor, _executor_workers
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown()
+            _executor = None
+            _executor_workers = 0
+
+
+atexit.register(shutdown_executor)
+
+
+def extract_from_pdf(pdf_data: Union[str, bytes, Path], workers: Optional[int] = None) -> List[Dict]:
     """PDFからテキストを抽出
 
     Args:
         pdf_data: ファイルパス、バイトデータ、またはPathオブジェクト
+        workers: 抽出に使うプロセス数（省略時はEXTRACT_WORKERS）。
+            PARALLEL_MIN_PAGESページ以上のPDFは連続したページ範囲に分けて並列に抽出する
 
     Returns:
         [{"page": ページ番号(1-indexed), "text": テキスト}, ...]
     """
-    if isinstance(pdf_data, (str, Path)):
-        pdf_path = Path(pdf_data)
-        if not pdf_path.exists():
-            raise FileNotFoundError(f"ファイルが見つかりません: {pdf_data}")
-        doc = fitz.open(str(pdf_path))
-    else:
-        doc = fitz.open(stream=io.BytesIO(pdf_data), filetype="pdf")
-
-    pages = []
-    with doc:
-        for i, page in enumerate(doc, 1):
-            text = page.get_text()
-            if text and text.strip():
-                # テキスト整形: 連続空白を1つに、句点で改行
-                text = re.sub(r'\s+', ' ', text)
-                text = re.sub(r'。', '。\n', text)
-                pages.append({"page": i, "text": text.strip()})
-
-    return pages
+    if isinstance(pdf_data, (str, Path)) and not Path(pdf_data).exists():
+        raise FileNotFoundError(f"ファイルが見つかりません: {pdf_data}")
+    workers = workers or EXTRACT_WORKERS
+
+    with _open_pdf(pdf_data) as doc:
+        page_count = doc.page_count
+        if workers <= 1 or page_count < PARALLEL_MIN_PAGES:
+            return _extract_pages(doc, range(page_count))
+
+    # 各ワーカーがPDFを開き直す（fitzのオブジェクトはプロセス間で渡せない）
+    step = -(-page_count // workers)
+    blocks = [range(start, min(start + step, page_count)) for start in range(0, page_count, step)]
+    results = _get_executor(workers).map(_extract_block, [pdf_data] * len(blocks), blocks)
+    return [page for block in results for page in block]
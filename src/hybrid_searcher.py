@@ -1,9 +1,11 @@
 """ハイブリッド検索 - ベクトル + BM25 + リランキング"""
 
 from typing import List, Tuple, Dict, Any, Optional
+from collections import defaultdict
 from dataclasses import dataclass
+from operator import itemgetter
 import logging
-import math
+import numpy as np
 
 from .embedder import Embedder
 from .indexer import Indexer
@@ -13,14 +15,15 @@ from .reranker import get_reranker
 logger = logging.getLogger(__name__)
 
 
-@dataclass
+@dataclass(frozen=True)
 class SearchConfig:
-    """検索設定"""
+    """検索設定（共有されるためイミュータブル）"""
     use_bm25: bool = True
     use_rerank: bool = True
     retrieval_k: int = 100  # RRF候補数（増やしても速度影響小）
     rerank_top_k: int = 20  # rerank対象数（速度に直結）
     rerank_weight: float = 0.5  # reranker:RRF = 50:50でブレンド
+    ef_search: Optional[int] = None  # HNSW探索幅（Noneでインデックス既定値）
 
 
 class HybridSearcher:
@@ -44,19 +47,37 @@ class HybridSearcher:
         config: Optional[SearchConfig] = None
     ) -> List[Tuple[Dict[str, Any], float]]:
         """ハイブリッド検索"""
+        query_vec = self.embedder.generate_query_embedding(query)
+        return self.search_with_query_vector(query, query_vec, top_k, config)
+
+    def search_with_query_vector(
+        self,
+        query: str,
+        query_vec: np.ndarray,
+        top_k: int = 10,
+        config: Optional[SearchConfig] = None
+    ) -> List[Tuple[Dict[str, Any], float]]:
+        """ベクトル化済みクエリでハイブリッド検索
+
+        queryはBM25とリランキングに、query_vecはベクトル検索に使う。
+        """
         if config is None:
             config = SearchConfig()
 
         # 1. ベクトル検索
-        query_vec = self.embedder.generate_query_embedding(query)
-        vector_results = self.indexer.search(query_vec, config.retrieval_k)
+        vector_hits = self.indexer.search_ids(query_vec, config.retrieval_k, config.ef_search)
+        # 2. BM25検索
+        bm25_hits = self.bm25.search(query, config.retrieval_k) if config.use_bm25 else []
+
+        # メタデータは両方の結果をまとめて1回で取得（重複するIDも1回だけ）
+        rows = self.indexer.db.get_metadata_map(list({i for i, _ in vector_hits + bm25_hits}))
+        vector_results = [(rows[i], s) for i, s in vector_hits if i in rows]
 
         if not config.use_bm25:
             candidates = vector_results
         else:
-            # 2. BM25検索
-            bm25_results = self.bm25.search(query, config.retrieval_k)
             # 3. RRFで融合
+            bm25_results = [(rows[i], s) for i, s in bm25_hits if i in rows]
             candidates = self._rrf(vector_results, bm25_results)
 
         # 4. リランキング（RRFスコアとブレンド）
@@ -72,54 +93,42 @@ class HybridSearcher:
             rrf_scores = {doc_key(c[0]): c[1] for c in candidates}
             max_rrf = max(rrf_scores.values()) if rrf_scores else 1.0
 
-            # rerankerスコアとRRFスコアをブレンド
-            blended = []
-            for metadata, rerank_score in reranked:
-                rrf_norm = rrf_scores.get(doc_key(metadata), 0) / max_rrf
-                # rerankerスコアを0-1にシグモイド正規化
-                rerank_norm = 1 / (1 + math.exp(-rerank_score))
-                final_score = (
-                    config.rerank_weight * rerank_norm +
-                    (1 - config.rerank_weight) * rrf_norm
-                )
-                blended.append((metadata, final_score))
-
-            blended.sort(key=lambda x: x[1], reverse=True)
-            return blended[:top_k]
+            # rerankerスコアとRRFスコアをブレンド（候補全体をまとめてベクトル計算）
+            metadata_list = [m for m, _ in reranked]
+            rerank_scores = np.array([score for _, score in reranked], dtype=np.float64)
+            rrf_norm = np.array([rrf_scores.get(doc_key(m), 0) for m in metadata_list]) / max_rrf
+            # rerankerスコアを0-1にシグモイド正規化
+            rerank_norm = 1 / (1 + np.exp(-rerank_scores))
+            final_scores = config.rerank_weight * rerank_norm + (1 - config.rerank_weight) * rrf_norm
+
+            top = np.argsort(-final_scores, kind='stable')[:top_k]
+            return [(metadata_list[i], float(final_scores[i])) for i in top.tolist()]
 
         return candidates[:top_k]
 
     def _rrf(
         self,
         vector_results: List[Tuple[Dict, float]],
-        bm25_results: List[Tuple[int, float]],
+        bm25_results: List[Tuple[Dict, float]],
         k: int = 60
     ) -> List[Tuple[Dict, float]]:
         """Reciprocal Rank Fusion
 
         RRF(d) = Σ 1 / (k + rank(d))
         """
-        rrf_scores: Dict[int, float] = {}
-        doc_metadata: Dict[int, Dict] = {}
-
-        # ベクトル検索結果
-        for rank, (metadata, _) in enumerate(vector_results):
-            doc_key = hash((metadata.get("file", ""), metadata.get("page", 0)))
-            rrf_scores[doc_key] = rrf_scores.get(doc_key, 0) + 1.0 / (k + rank + 1)
-            doc_metadata[doc_key] = metadata
-
-        # BM25結果（バッチ取得）
-        bm25_indices = [idx for idx, _ in bm25_results]
-        bm25_metadata_list = self.indexer.db.get_metadata(bm25_indices)
-
-        for rank, metadata in enumerate(bm25_metadata_list):
-            if not metadata:
-                continue
-            doc_key = hash((metadata.get("file", ""), metadata.get("page", 0)))
-            rrf_scores[doc_key] = rrf_scores.get(doc_key, 0) + 1.0 / (k + rank + 1)
-            if doc_key not in doc_metadata:
-                doc_metadata[doc_key] = metadata
+        # 同じページのチャンクは1文書として扱う。キーはタプルのまま使う（hash()の衝突で別文書が混ざらない）
+        rrf_scores: Dict[Tuple[str, int], float] = defaultdict(float)
+        doc_metadata: Dict[Tuple[str, int], Dict] = {}
+
+        # 順位ごとの重みは両リストで共通なので1回だけ計算
+        weights = (1.0 / (k + np.arange(1, max(len(vector_results), len(bm25_results)) + 1))).tolist()
+
+        for results in (vector_results, bm25_results):
+            for weight, (metadata, _) in zip(weights, results):
+                doc_key = (metadata.get("file", ""), metadata.get("page", 0))
+                rrf_scores[doc_key] += weight
+                doc_metadata.setdefault(doc_key, metadata)
 
         # スコア順にソート
-        sorted_docs = sorted(rrf_scores.items(), key=lambda x: x[1], reverse=True)
+        sorted_docs = sorted(rrf_scores.items(), key=itemgetter(1), reverse=True)
         return [(doc_metadata[doc_key], s) for doc_key, s in sorted_docs]
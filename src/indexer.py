@@ -1,9 +1,11 @@
 """ベクトルインデックス - FAISSによる高速類似検索"""
 
-from typing import List, Dict, Tuple
+from typing import List, Dict, Optional, Tuple
 import numpy as np
 import faiss
+import orjson
 import os
+import re
 from pathlib import Path
 import logging
 
@@ -11,20 +13,49 @@ from .database import Database
 
 logger = logging.getLogger(__name__)
 
+# 大規模コーパス向けに環境変数で構成を変更可能（例: IVF4096,PQ32x4fs,Refine(SQ8)）
+DEFAULT_INDEX_KEY = os.environ.get("KUGUTSUSHI_INDEX_KEY", "IVF256,PQ32x4fs,Refine(SQ8)")
+# 未指定なら訓練時にコーパスごとに自動調整する（目標再現率を満たす最小のnprobe）
+DEFAULT_NPROBE = int(os.environ["KUGUTSUSHI_NPROBE"]) if os.environ.get("KUGUTSUSHI_NPROBE") else None
+NPROBE_TARGET_RECALL = float(os.environ.get("KUGUTSUSHI_NPROBE_TARGET_RECALL", "0.95"))
+FALLBACK_NPROBE = 10  # 自動調整前に保存されたインデックス用
+# 再ランキング対象 = top_k × この倍率（Refineなしのキーでは無視）
+REFINE_K_FACTOR = int(os.environ.get("KUGUTSUSHI_REFINE_K_FACTOR", "20"))
+
 
 class Indexer:
     """FAISSベクトルインデックス
 
-    IVF-PQ (IVF256,PQ16,RFlat) を使用:
+    IVF-PQ (既定: IVF256,PQ32x4fs,Refine(SQ8)、KUGUTSUSHI_INDEX_KEYで変更可) を使用:
     - IVF256: 256クラスタで粗い検索を高速化
-    - PQ16: 16サブベクトルに分割して圧縮
-    - RFlat: 正確な距離で再ランキング
+    - PQ32x4fs: 32サブベクトル×4bitに圧縮（PQ16と同じ16バイト/ベクトル）。
+      FastScanでSIMDのテーブル引きにより32件ずつ距離計算し、訓練も速い
+    - Refine(SQ8): int8スカラー量子化ベクトルで再ランキング（RFlatの1/4のメモリ）
+
+    訓練データが貯まるまでの一時インデックスはHNSW（グラフ探索で準線形検索、ベクトルはfp16で保持）。
+    ef_searchが大きいほど再現率が上がり、遅くなる。
     """
 
-    def __init__(self, dimension: int = 512, index_key: str = "IVF256,PQ16,RFlat"):
+    def __init__(
+        self,
+        dimension: int = 512,
+        index_key: str = DEFAULT_INDEX_KEY,
+        nprobe: Optional[int] = DEFAULT_NPROBE,
+        refine_k_factor: int = REFINE_K_FACTOR,
+        hnsw_m: int = 32,
+        ef_construction: int = 200,
+        ef_search: int = 64
+    ):
         self.dimension = dimension
         self.index_key = index_key
-        self.min_training_size = 39 * 256  # IVF256の訓練に必要な最小データ数
+        self.auto_nprobe = nprobe is None
+        self.nprobe = nprobe
+        self.refine_k_factor = refine_k_factor
+        self.hnsw_m = hnsw_m
+        self.ef_construction = ef_construction
+        self.ef_search = ef_search
+        self.min_training_size = self._min_training_size(index_key)
+        self.read_only = False  # load(mmap=True)で読み込んだ場合は追加・保存できない
 
         # 初期状態は一時インデックス（訓練データが貯まるまで）
         self._init_temp_index()
@@ -32,35 +63,112 @@ class Indexer:
         # メタデータはSQLiteで管理
         self.db = Database()
 
+    @staticmethod
+    def _min_training_size(index_key: str) -> int:
+        """IVFの訓練に必要な最小データ数（FAISS推奨: クラスタ数×39）"""
+        # OPQ等の前処理が前に付くキー（例: OPQ16_64,IVF256,PQ16）でもIVFの指定を拾う
+        match = re.search(r"IVF(\d+)", index_key)
+        nlist = int(match.group(1)) if match else 256
+        return 39 * nlist
+
+    def _set_search_params(self) -> None:
+        """検索パラメータを設定
+
+        nprobeはRefine等のラッパー越しでも内側のIVFに効くようParameterSpaceで設定。
+        再ランキングはk_factor倍の候補に対して行う。
+        """
+        faiss.ParameterSpace().set_index_parameter(self.index, "nprobe", self.nprobe)
+        if isinstance(self.index, faiss.IndexRefine):
+            self.index.k_factor = self.refine_k_factor
+
     def _init_temp_index(self) -> None:
         """一時インデックスの初期化（少量データ用）"""
-        self.temp_index = faiss.IndexFlatIP(self.dimension)
+        self.temp_index = self._new_hnsw_index()
         self.index = None
         self.is_trained = False
 
+    def _new_hnsw_index(self) -> faiss.IndexHNSWSQ:
+        # fp16はfloat32の半分のメモリで、再現率はほぼ変わらない（訓練不要）
+        index = faiss.IndexHNSWSQ(
+            self.dimension, faiss.ScalarQuantizer.QT_fp16, self.hnsw_m, faiss.METRIC_INNER_PRODUCT
+        )
+        index.hnsw.efConstruction = self.ef_construction
+        index.hnsw.efSearch = self.ef_search
+        return index
+
+    def _to_hnsw(self, index: faiss.Index) -> faiss.IndexHNSWSQ:
+        """旧形式の一時インデックス（IndexFlatIP、IndexHNSWFlat）をfp16 HNSWに変換"""
+        hnsw = self._new_hnsw_index()
+        if index.ntotal > 0:
+            vectors = np.empty((index.ntotal, self.dimension), dtype=np.float32)
+            index.reconstruct_n(0, index.ntotal, vectors)
+            hnsw.add(vectors)
+        return hnsw
+
     def _init_ivf_pq(self, vectors: np.ndarray) -> None:
         """IVF-PQインデックスの初期化と訓練"""
         logger.info(f"IVF-PQインデックスの訓練を開始（データ数: {len(vectors)}）")
 
         self.index = faiss.index_factory(self.dimension, self.index_key, faiss.METRIC_INNER_PRODUCT)
 
-        if hasattr(self.index, 'k_factor_rf'):
-            self.index.k_factor_rf = 10
-
         self.index.train(vectors)
         self.index.add(vectors)
+        if self.auto_nprobe:
+            self.nprobe = self._tune_nprobe(vectors)
+        self._set_search_params()
         self.is_trained = True
         self.temp_index = None
 
         logger.info("IVF-PQインデックスの訓練が完了")
 
-    def _normalize(self, vectors: np.ndarray) -> np.ndarray:
-        """L2正規化（コサイン類似度のため）"""
+    def _tune_nprobe(
+        self,
+        vectors: np.ndarray,
+        target_recall: float = NPROBE_TARGET_RECALL,
+        top_k: int = 10,
+        sample_size: int = 200
+    ) -> int:
+        """目標再現率を満たす最小のnprobeを選ぶ
+
+        訓練データの一部をクエリにし、全件探索の結果を正解としてnprobeを1から倍々に試す。
+        クエリ自身は必ず見つかり再現率を甘くするため、正解・検索結果の両方から除く。
+        """
+        rng = np.random.default_rng(0)
+        sample = rng.choice(len(vectors), min(sample_size, len(vectors)), replace=False)
+        queries = vectors[sample]
+
+        def neighbors(index: faiss.Index) -> List[set]:
+            _, found = index.search(queries, top_k + 1)
+            return [set([i for i in row if i != q][:top_k]) for q, row in zip(sample.tolist(), found.tolist())]
+
+        exact = faiss.IndexFlatIP(self.dimension)
+        exact.add(vectors)
+        truth = neighbors(exact)
+
+        if isinstance(self.index, faiss.IndexRefine):
+            self.index.k_factor = self.refine_k_factor
+        nlist = faiss.extract_index_ivf(self.index).nlist
+        params = faiss.ParameterSpace()
+        nprobe, recall = 1, 0.0
+        while True:
+            params.set_index_parameter(self.index, "nprobe", nprobe)
+            recall = np.mean([len(f & t) / top_k for f, t in zip(neighbors(self.index), truth)])
+            if recall >= target_recall or nprobe >= nlist:
+                break
+            nprobe = min(nprobe * 2, nlist)
+
+        logger.info(f"nprobeを自動調整: {nprobe}（再現率@{top_k}: {recall:.3f}）")
+        return nprobe
+
+    def _as_matrix(self, vectors: np.ndarray) -> np.ndarray:
+        """FAISSに渡せる2次元float32配列に変換（必要な場合のみコピー）
+
+        ベクトルはEmbedderで正規化済みの前提（内積 = コサイン類似度）。
+        """
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
         if vectors.ndim == 1:
             vectors = vectors.reshape(1, -1)
-        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
-        norms = np.maximum(norms, np.finfo(vectors.dtype).tiny)
-        return vectors / norms
+        return vectors
 
     def add(self, vectors: np.ndarray, metadata: List[Dict]) -> None:
         """ベクトルとメタデータを追加
@@ -68,19 +176,18 @@ class Indexer:
         重要: ベクトルを先に追加し、成功後にメタデータを追加。
         これにより、途中クラッシュ時のデータ不整合を防ぐ。
         """
+        if self.read_only:
+            raise RuntimeError("mmapで読み込んだインデックスには追加できません")
         if len(vectors) == 0:
             return
 
-        if isinstance(vectors, list):
-            vectors = np.array(vectors, dtype=np.float32)
-
-        normalized = self._normalize(vectors.copy())
+        vectors = self._as_matrix(vectors)
 
         # 1. ベクトルを先に追加
         if self.is_trained:
-            self.index.add(normalized)
+            self.index.add(vectors)
         else:
-            self.temp_index.add(normalized)
+            self.temp_index.add(vectors)
 
         # 2. ベクトル追加成功後にメタデータを追加
         start_id = self.db.get_metadata_count()
@@ -92,29 +199,60 @@ class Indexer:
             self.temp_index.reconstruct_n(0, self.temp_index.ntotal, all_vectors)
             self._init_ivf_pq(all_vectors)
 
-    def search(self, query_vector: np.ndarray, top_k: int = 10) -> List[Tuple[Dict, float]]:
-        """ベクトル検索"""
-        active = self.index if self.is_trained else self.temp_index
+    def search(
+        self,
+        query_vector: np.ndarray,
+        top_k: int = 10,
+        ef_search: Optional[int] = None
+    ) -> List[Tuple[Dict, float]]:
+        """ベクトル検索（メタデータ付き）
 
-        if active is None or active.ntotal == 0:
-            return []
+        ef_search: 一時インデックス（HNSW）の探索幅。Noneならインスタンスの既定値
+        """
+        hits = self.search_ids(query_vector, top_k, ef_search)
+        rows = self.db.get_metadata_map([i for i, _ in hits])
+        return [(rows[i], s) for i, s in hits if i in rows]
+
+    def search_ids(
+        self,
+        query_vector: np.ndarray,
+        top_k: int = 10,
+        ef_search: Optional[int] = None
+    ) -> List[Tuple[int, float]]:
+        """ベクトル検索（メタデータは取得せず [(id, スコア), ...] を返す）
+
+        ハイブリッド検索でBM25の結果とまとめてメタデータを取得するために使う。
+        """
+        return self.search_ids_batch(query_vector, top_k, ef_search)[0]
 
-        if isinstance(query_vector, list):
-            query_vector = np.array(query_vector, dtype=np.float32)
-        if query_vector.ndim == 1:
-            query_vector = query_vector.reshape(1, -1)
+    def search_ids_batch(
+        self,
+        query_vectors: np.ndarray,
+        top_k: int = 10,
+        ef_search: Optional[int] = None
+    ) -> List[List[Tuple[int, float]]]:
+        """複数クエリをまとめてベクトル検索（クエリごとに [(id, スコア), ...] を返す）
 
-        normalized = self._normalize(query_vector.copy())
+        FAISSに1回で渡すため、クエリごとに呼ぶより呼び出しのオーバーヘッドが小さい。
+        """
+        query_vectors = self._as_matrix(query_vectors)
+        active = self.index if self.is_trained else self.temp_index
 
-        if self.is_trained:
-            self.index.nprobe = 10
+        if active is None or active.ntotal == 0:
+            return [[] for _ in range(len(query_vectors))]
 
-        scores, indices = active.search(normalized, top_k)
-        indices = indices[0]
-        scores = scores[0]
+        if self.is_trained:
+            scores, indices = active.search(query_vectors, top_k)
+        else:
+            # efSearchはtop_k以上でないと候補が足りない
+            ef = max(ef_search or self.ef_search, top_k)
+            params = faiss.SearchParametersHNSW(efSearch=ef)
+            scores, indices = active.search(query_vectors, top_k, params=params)
 
-        metadata_list = self.db.get_metadata([int(i) for i in indices if i >= 0])
-        return [(m, float(s)) for m, s in zip(metadata_list, scores) if m]
+        return [
+            [(i, s) for i, s in zip(row_ids, row_scores) if i >= 0]
+            for row_ids, row_scores in zip(indices.tolist(), scores.tolist())
+        ]
 
     def get_vector_count(self) -> int:
         """ベクトル数を取得"""
@@ -126,6 +264,8 @@ class Indexer:
 
     def save(self, index_dir: str = "embeddings") -> None:
         """インデックスを保存（FAISSバイナリ + メタデータ）"""
+        if self.read_only:
+            raise RuntimeError("mmapで読み込んだインデックスは保存できません")
         index_dir = Path(index_dir)
         index_dir.mkdir(exist_ok=True)
 
@@ -133,29 +273,40 @@ class Indexer:
         faiss_path = index_dir / "faiss.index"
         active = self.index if self.is_trained else self.temp_index
 
+        # 一時ファイルに書いてから置き換え（書き込み中のクラッシュで既存インデックスを壊さない）
         if active and active.ntotal > 0:
-            faiss.write_index(active, str(faiss_path))
+            tmp_path = faiss_path.with_suffix(".index.tmp")
+            faiss.write_index(active, str(tmp_path))
+            os.replace(tmp_path, faiss_path)
 
         # 訓練状態を保存
         state_path = index_dir / "index_state.json"
-        import json
-        state_path.write_text(json.dumps({
+        tmp_state_path = state_path.with_suffix(".json.tmp")
+        tmp_state_path.write_bytes(orjson.dumps({
             "is_trained": self.is_trained,
             "dimension": self.dimension,
             "index_key": self.index_key,
+            "nprobe": self.nprobe,
             "vector_count": self.get_vector_count(),
         }))
+        os.replace(tmp_state_path, state_path)
 
         # メタデータをフラッシュ
         self.db.flush()
+        self.db.checkpoint()
 
         faiss_size = os.path.getsize(faiss_path) / (1024 * 1024) if faiss_path.exists() else 0
         db_size = os.path.getsize(self.db.db_path) / (1024 * 1024)
         logger.info(f"保存: ベクトル{self.get_vector_count()}件 (FAISS {faiss_size:.1f}MB), DB ({db_size:.1f}MB)")
 
-    def load(self, index_dir: str = "embeddings") -> None:
-        """インデックスを読み込み（FAISSバイナリから高速ロード）"""
-        import json
+    def load(self, index_dir: str = "embeddings", mmap: bool = False) -> None:
+        """インデックスを読み込み（FAISSバイナリから高速ロード）
+
+        Args:
+            index_dir: インデックスのディレクトリ
+            mmap: 訓練済みインデックスの転置リストをメモリマップで読む（検索専用）。
+                読み込みが速くRSSも小さいが、以後add()/save()はできない
+        """
         index_dir = Path(index_dir)
         faiss_path = index_dir / "faiss.index"
         state_path = index_dir / "index_state.json"
@@ -163,17 +314,30 @@ class Indexer:
 
         # 新形式: FAISSバイナリから読み込み（高速）
         if faiss_path.exists() and state_path.exists():
-            state = json.loads(state_path.read_text())
+            state = orjson.loads(state_path.read_bytes())
             self.is_trained = state.get("is_trained", False)
 
-            loaded_index = faiss.read_index(str(faiss_path))
+            if mmap and self.is_trained:
+                loaded_index = faiss.read_index(str(faiss_path), faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+                self.read_only = True
+            else:
+                loaded_index = faiss.read_index(str(faiss_path))
 
             if self.is_trained:
+                self.index_key = state.get("index_key", self.index_key)
+                if self.auto_nprobe:
+                    self.nprobe = state.get("nprobe") or FALLBACK_NPROBE
                 self.index = loaded_index
                 self.temp_index = None
-            else:
+                self._set_search_params()
+            elif isinstance(loaded_index, faiss.IndexHNSWSQ):
+                loaded_index.hnsw.efSearch = self.ef_search  # efSearchは保存されない
                 self.temp_index = loaded_index
                 self.index = None
+            else:
+                logger.info("一時インデックスをHNSWに変換中...")
+                self.temp_index = self._to_hnsw(loaded_index)
+                self.index = None
 
             logger.info(f"読み込み: ベクトル{self.get_vector_count()}件, メタデータ{self.db.get_metadata_count()}件")
             return
@@ -1,10 +1,9 @@
 """インデックス作成 - PDF処理からインデックス追加までの共通ライブラリ"""
 
-from typing import List, Dict, Tuple
+from typing import List, Dict, Optional, Tuple, Union
 from pathlib import Path
 import numpy as np
 import logging
-import gc
 
 from .embedder import Embedder
 from .indexer import Indexer
@@ -15,6 +14,7 @@ from .bm25_indexer import BM25Indexer
 logger = logging.getLogger(__name__)
 
 BATCH_SIZE = 32
+MIN_CHUNK_LENGTH = 32  # これより短い断片チャンク（ページ末尾の切れ端等）は埋め込まない
 
 
 class IndexBuilder:
@@ -43,29 +43,50 @@ class IndexBuilder:
         self.indexer.save()
         self.bm25.save()
 
-    def add_pdf(self, pdf_data: bytes, filename: str) -> Tuple[int, str]:
+    def add_pdf(self, pdf_data: Union[bytes, Path], filename: str) -> Tuple[int, str]:
         """PDFをインデックスに追加
 
         Args:
-            pdf_data: PDFのバイナリデータ
+            pdf_data: PDFのバイナリデータ、またはファイルパス（全体をメモリに読み込まない）
             filename: ファイル名
 
         Returns:
             (追加チャンク数, メッセージ)
         """
+        metadata, message = self.prepare_pdf(pdf_data, filename)
+        if not metadata:
+            return 0, message
+        return self.add_chunks(metadata)
+
+    def prepare_pdf(self, pdf_data: Union[bytes, Path], filename: str) -> Tuple[List[Dict], str]:
+        """PDFからテキストを抽出してチャンクに分割（埋め込み前の段階）
+
+        埋め込みモデルやインデックスには触れないため、別スレッドで次のPDFを
+        準備しながら現在のPDFを埋め込むことができる。
+
+        Returns:
+            (チャンクのメタデータ, メッセージ)。チャンクがなければ空リスト
+        """
         try:
             # テキスト抽出
             pages = extract_from_pdf(pdf_data)
             pages = [p for p in pages if is_content_page(p["text"])]
 
             if not pages:
-                return 0, "テキストなし"
+                return [], "テキストなし"
 
             # チャンキング: 各ページを500文字程度に分割
             metadata = []
+            dropped = 0
             for p in pages:
                 chunks = chunk_text(p["text"].strip())
                 for i, chunk in enumerate(chunks):
+                    if not chunk:
+                        continue
+                    # ページに他のチャンクがあれば、短い切れ端は捨てる（ページ自体は失わない）
+                    if len(chunk) < MIN_CHUNK_LENGTH and len(chunks) > 1:
+                        dropped += 1
+                        continue
                     metadata.append({
                         "text": chunk,
                         "file": filename,
@@ -73,41 +94,89 @@ class IndexBuilder:
                         "chunk": i,
                     })
 
+            if dropped:
+                logger.debug(f"短いチャンクを除外: {dropped}件 ({filename})")
+
             if not metadata:
-                return 0, "チャンクなし"
+                return [], "チャンクなし"
+            return metadata, "OK"
+
+        except Exception as e:
+            logger.error(f"PDF処理エラー: {e}")
+            return [], str(e)
+
+    def add_chunks(self, metadata: List[Dict]) -> Tuple[int, str]:
+        """prepare_pdfで作ったチャンクを埋め込んでインデックスに追加
+
+        Returns:
+            (追加チャンク数, メッセージ)
+        """
+        vectors, message = self.embed_chunks(metadata)
+        if vectors is None:
+            return 0, message
+        return self.index_chunks(metadata, vectors)
 
-            # ベクトル生成（バッチ処理）
-            text_list = [m["text"] for m in metadata]
-            vectors = self._generate_vectors_batch(text_list)
+    def embed_chunks(self, metadata: List[Dict]) -> Tuple[Optional[np.ndarray], str]:
+        """チャンクを埋め込む（インデックスは変更しないため、検索と並行して実行できる）
 
-            # インデックスに追加
+        Returns:
+            (ベクトル, メッセージ)。失敗時はベクトルがNone
+        """
+        try:
+            return self._generate_vectors_batch([m["text"] for m in metadata]), "OK"
+        except Exception as e:
+            logger.error(f"PDF処理エラー: {e}")
+            return None, str(e)
+
+    def index_chunks(self, metadata: List[Dict], vectors: np.ndarray) -> Tuple[int, str]:
+        """埋め込み済みのチャンクをインデックスに追加
+
+        Returns:
+            (追加チャンク数, メッセージ)
+        """
+        try:
             self.indexer.add(vectors, metadata)
-            self.bm25.add(text_list)
+            self.bm25.add([m["text"] for m in metadata])
 
             return len(metadata), "OK"
 
         except Exception as e:
             logger.error(f"PDF処理エラー: {e}")
             return 0, str(e)
-        finally:
-            gc.collect()
 
     def add_pdf_file(self, path: Path) -> Tuple[int, str]:
         """PDFファイルをインデックスに追加"""
-        content = path.read_bytes()
-        result = self.add_pdf(content, path.name)
-        del content
-        gc.collect()
-        return result
+        return self.add_pdf(path.read_bytes(), path.name)
 
     def _generate_vectors_batch(self, texts: List[str]) -> np.ndarray:
-        """バッチでベクトル生成"""
-        vectors = []
-        for i in range(0, len(texts), BATCH_SIZE):
-            batch = texts[i:i + BATCH_SIZE]
-            batch_vecs = self.embedder.generate_document_embeddings(batch)
-            vectors.extend(batch_vecs)
-        return np.array(vectors, dtype=np.float32)
+        """バッチでベクトル生成
+
+        ヘッダ・フッタ等の同一テキストは1回だけ埋め込み、結果を元の位置に展開する。
+        """
+        unique: Dict[str, int] = {}
+        inverse = np.fromiter(
+            (unique.setdefault(t, len(unique)) for t in texts), dtype=np.int64, count=len(texts)
+        )
+        unique_texts = list(unique)
+
+        # 長さ順に並べてバッチを組み、バッチ内のパディングを減らす
+        # （バッチ単位で渡すため、モデル側の長さソートはバッチ内にしか効かない）
+        order = np.argsort(
+            np.fromiter((len(t) for t in unique_texts), dtype=np.int64, count=len(unique_texts)),
+            kind="stable"
+        )[::-1]
+
+        # 結果配列を先に確保し、バッチごとに元の位置へ書き込む（中間リストとコピーを作らない）
+        vectors = np.empty((len(unique_texts), self.embedder.dimension), dtype=np.float32)
+        for i in range(0, len(order), BATCH_SIZE):
+            positions = order[i:i + BATCH_SIZE]
+            vectors[positions] = self.embedder.generate_document_embeddings(
+                [unique_texts[j] for j in positions], batch_size=BATCH_SIZE
+            )
+
+        if len(unique_texts) == len(texts):
+            return vectors
+        return vectors[inverse]
 
     def verify(self) -> Tuple[bool, str]:
         """整合性チェック"""
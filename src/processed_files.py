@@ -0,0 +1,81 @@
+"""処理済みファイル管理 - インデックス済みPDF名の永続化"""
+
+from typing import Set, Iterator
+from pathlib import Path
+import orjson
+import os
+import threading
+
+
+class ProcessedFiles:
+    """処理済みファイル名の集合
+
+    batch_index.py と api.py で共有。
+    1行1ファイル名のテキストとして保存する（旧形式のJSONは読み込み時に移行）。
+    保存は追記のみで、前回の保存以降に追加された行だけを書く（件数に依存しないO(1)）。
+    ファイルがない場合や旧形式からの移行時は、一時ファイルに全件を書いて os.replace で置き換える。
+    前回の保存から変化がなければ書き込みをスキップする。
+    save()はスレッドから呼ばれるため、集合の更新はロックで保護する。
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.files: Set[str] = set()
+        self._saved: frozenset = frozenset()
+        self._needs_newline = False  # 既存ファイルの末尾に改行がない（旧い書き出し形式）
+        self._lock = threading.Lock()
+
+    def load(self) -> None:
+        """ファイルから読み込み"""
+        legacy = self.path.with_suffix('.json')
+        self._needs_newline = False
+        if self.path.exists():
+            text = self.path.read_text(encoding='utf-8')
+            self.files = {line for line in text.splitlines() if line}
+            self._saved = frozenset(self.files)
+            self._needs_newline = bool(text) and not text.endswith('\n')
+        elif legacy.exists():
+            # 旧形式（JSON配列）: 次回のsave()で新形式に書き出す
+            self.files = set(orjson.loads(legacy.read_bytes()))
+            self._saved = frozenset()
+        else:
+            self.files = set()
+            self._saved = frozenset()
+
+    def save(self) -> bool:
+        """変更があれば保存（新規分を追記）
+
+        Returns:
+            書き込みを行ったか
+        """
+        with self._lock:
+            if self.files == self._saved:
+                return False
+            snapshot = frozenset(self.files)
+
+        if self._saved and self.path.exists():
+            added = sorted(snapshot - self._saved)
+            prefix = "\n" if self._needs_newline else ""
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(prefix + "".join(name + "\n" for name in added))
+        else:
+            tmp = self.path.with_suffix(self.path.suffix + '.tmp')
+            tmp.write_text("".join(name + "\n" for name in sorted(snapshot)), encoding='utf-8')
+            os.replace(tmp, self.path)
+
+        self._saved = snapshot
+        self._needs_newline = False
+        return True
+
+    def add(self, filename: str) -> None:
+        with self._lock:
+            self.files.add(filename)
+
+    def __contains__(self, filename: str) -> bool:
+        return filename in self.files
+
+    def __len__(self) -> int:
+        return len(self.files)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.files)
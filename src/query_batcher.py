@@ -0,0 +1,101 @@
+"""クエリバッチャー - 同時に届いた検索クエリの埋め込みをまとめて計算"""
+
+from collections import OrderedDict
+from typing import Callable, List, Optional, Set, Tuple
+import asyncio
+import logging
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class QueryBatcher:
+    """同時リクエストのクエリ埋め込みを1回のバッチにまとめる
+
+    最初のクエリが届いてから最大max_wait秒待ち、その間に届いたクエリを
+    まとめてembed_batchに渡す（max_batch_size件に達したら即座に実行）。
+    embed_batchはスレッドで実行し、イベントループを塞がない。
+    計算済みのクエリは直近cache_size件をLRUで保持し、再計算しない（0で無効）。
+    """
+
+    def __init__(
+        self,
+        embed_batch: Callable[[List[str]], np.ndarray],
+        max_batch_size: int = 32,
+        max_wait: float = 0.01,
+        cache_size: int = 4096
+    ):
+        self.embed_batch = embed_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.cache_size = cache_size
+        self._cache: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._pending: List[Tuple[str, asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._tasks: Set[asyncio.Task] = set()
+
+    async def embed(self, query: str) -> np.ndarray:
+        """クエリをベクトル化（他の同時リクエストとまとめて計算される）"""
+        query = query.strip()
+        vector = self._cache.get(query)
+        if vector is not None:
+            self._cache.move_to_end(query)
+            self.hits += 1
+            return vector
+        self.misses += 1
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((query, future))
+
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_wait, self._flush)
+
+        return await future
+
+    def _flush(self) -> None:
+        """待機中のクエリをバッチとして実行"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+
+        task = asyncio.ensure_future(self._run(batch))
+        # 実行中のタスクが回収されないよう参照を保持
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch: List[Tuple[str, asyncio.Future]]) -> None:
+        queries = [q for q, _ in batch]
+        try:
+            vectors = await asyncio.to_thread(self.embed_batch, queries)
+        except Exception as e:
+            logger.error(f"クエリ埋め込みエラー: {e}")
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        if len(batch) > 1:
+            logger.debug(f"クエリ {len(batch)}件をまとめて埋め込み")
+        for (query, future), vector in zip(batch, vectors):
+            self._remember(query, vector)
+            if not future.done():
+                future.set_result(vector)
+
+    def _remember(self, query: str, vector: np.ndarray) -> None:
+        if self.cache_size <= 0:
+            return
+        # キャッシュを共有するため呼び出し側で書き換えられないようにする
+        vector.flags.writeable = False
+        self._cache[query] = vector
+        self._cache.move_to_end(query)
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
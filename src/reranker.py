@@ -1,8 +1,14 @@
 """リランカー - Cross-Encoderによる再ランキング"""
 
+from collections import OrderedDict
 from typing import List, Tuple, Dict, Any, Optional
+from heapq import nlargest
+from operator import itemgetter
 import logging
+import os
+import threading
 import time
+import numpy as np
 
 logger = logging.getLogger(__name__)
 
@@ -15,24 +21,57 @@ class Reranker:
     hotchpotch/japanese-reranker-tiny-v2:
     - 3レイヤー, 256隠れ層
     - Raspberry Pi 4Bで約15-25ms/ペア
+    - CUDAがあればGPU（fp16）で推論する
+
+    quantize（既定は環境変数KUGUTSUSHI_QUANTIZE=1）でCPU推論をint8化する。
+    計算済みの(クエリ, 文書)ペアのスコアは直近cache_size件をLRUで保持し、再計算しない（0で無効）。
     """
 
-    def __init__(self, model_name: str = RERANKER_MODEL):
+    def __init__(
+        self,
+        model_name: str = RERANKER_MODEL,
+        quantize: Optional[bool] = None,
+        cache_size: int = 4096
+    ):
         self.model_name = model_name
         self.model = None
+        if quantize is None:
+            quantize = os.environ.get("KUGUTSUSHI_QUANTIZE") == "1"
+        self.quantize = quantize
+        self.cache_size = cache_size
+        self._cache: "OrderedDict[Tuple[str, str], float]" = OrderedDict()
+        self._lock = threading.Lock()  # 検索は複数スレッドから呼ばれる
 
     def _load_model(self) -> None:
-        """モデルを遅延ロード"""
+        """モデルを遅延ロード
+
+        検索は複数スレッドから呼ばれるため、ロックの中で読み込み・変換を終えてから公開する。
+        """
         if self.model is not None:
             return
 
-        logger.info(f"リランカーをロード: {self.model_name}")
-        start = time.time()
-
-        from sentence_transformers import CrossEncoder
-        self.model = CrossEncoder(self.model_name, max_length=512, device="cpu")
-
-        logger.info(f"リランカーロード完了: {time.time() - start:.2f}秒")
+        with self._lock:
+            if self.model is not None:
+                return
+
+            logger.info(f"リランカーをロード: {self.model_name}")
+            start = time.time()
+
+            from sentence_transformers import CrossEncoder
+            from .embedder import resolve_device
+            device = resolve_device()
+            model = CrossEncoder(self.model_name, max_length=512, device=device)
+            if device == "cuda":
+                model.model.half()  # 埋め込みモデルと同じくGPUではfp16で推論
+            elif self.quantize and device == "cpu":
+                import torch
+                # 埋め込みモデルと同じくLinear層をint8動的量子化（GPUでは無視）
+                torch.ao.quantization.quantize_dynamic(
+                    model.model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True
+                )
+            self.model = model
+
+            logger.info(f"リランカーロード完了: {time.time() - start:.2f}秒")
 
     def rerank(
         self,
@@ -44,23 +83,54 @@ class Reranker:
         if not results:
             return []
 
-        self._load_model()
-
-        pairs = [(query, r[0]["text"]) for r in results]
-
-        start = time.time()
-        scores = self.model.predict(pairs)
-        elapsed = time.time() - start
-
-        logger.debug(f"リランキング: {len(pairs)}件, {elapsed:.3f}秒")
-
-        reranked = sorted(zip(results, scores), key=lambda x: x[1], reverse=True)
-
+        texts = [r[0]["text"] for r in results]
+        scores = np.empty(len(texts), dtype=np.float32)
+        missing = []
+        with self._lock:
+            for i, text in enumerate(texts):
+                score = self._cache.get((query, text))
+                if score is None:
+                    missing.append(i)
+                else:
+                    self._cache.move_to_end((query, text))
+                    scores[i] = score
+
+        if missing:
+            self._load_model()
+
+            # 長さの近い文書を同じバッチにまとめ、バッチ内のパディングを減らす
+            # （バッチごとに最長の長さへ詰めるため。古いsentence-transformersは並べ替えない）
+            order = sorted(missing, key=lambda i: len(texts[i]))
+            pairs = [(query, texts[i]) for i in order]
+
+            start = time.time()
+            scores[order] = self.model.predict(pairs)
+            elapsed = time.time() - start
+
+            # 検索ごとに呼ばれるため、DEBUG無効時はメッセージを組み立てない
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"リランキング: {len(pairs)}件（キャッシュ{len(texts) - len(pairs)}件）, {elapsed:.3f}秒")
+
+            self._remember(pairs, scores[order])
+
+        # 上位だけ必要な場合は全件ソートしない
         if top_k:
-            reranked = reranked[:top_k]
+            reranked = nlargest(top_k, zip(results, scores), key=itemgetter(1))
+        else:
+            reranked = sorted(zip(results, scores), key=itemgetter(1), reverse=True)
 
         return [(item[0], float(score)) for item, score in reranked]
 
+    def _remember(self, pairs: List[Tuple[str, str]], scores: np.ndarray) -> None:
+        if self.cache_size <= 0:
+            return
+        with self._lock:
+            for pair, score in zip(pairs, scores.tolist()):
+                self._cache[pair] = score
+                self._cache.move_to_end(pair)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
 
 _reranker: Optional[Reranker] = None
 
@@ -0,0 +1,52 @@
+"""読み書きロック - 検索（共有）とインデックス更新（排他）の直列化"""
+
+from contextlib import contextmanager
+from typing import Iterator
+import threading
+
+
+class ReadWriteLock:
+    """複数の読み手、または1つの書き手だけを通すロック
+
+    書き手が待っている間は新しい読み手を待たせ、検索が続いても更新が止まらないようにする。
+    ブロックするため、イベントループ上ではなくスレッド（asyncio.to_thread）内で取得する。
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._readers = 0
+        self._writer = False
+        self._waiting_writers = 0
+
+    @contextmanager
+    def read(self) -> Iterator[None]:
+        """共有ロック（検索など、インデックスを読むだけの処理）"""
+        with self._cond:
+            while self._writer or self._waiting_writers:
+                self._cond.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if self._readers == 0:
+                    self._cond.notify_all()
+
+    @contextmanager
+    def write(self) -> Iterator[None]:
+        """排他ロック（追加・保存など、インデックスを変更する処理）"""
+        with self._cond:
+            self._waiting_writers += 1
+            try:
+                while self._writer or self._readers:
+                    self._cond.wait()
+            finally:
+                self._waiting_writers -= 1
+            self._writer = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writer = False
+                self._cond.notify_all()
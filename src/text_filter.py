@@ -14,6 +14,10 @@ SKIP_PATTERNS = [
     r'^chapter\s+\d+\s*$',
 ]
 
+# ページごとに呼ばれるため、正規表現はインポート時に一度だけコンパイルする
+PAGE_NUMBER_PATTERN = re.compile(r'^[\d\s\-\.]+$')
+SKIP_REGEXES = [re.compile(p, re.IGNORECASE) for p in SKIP_PATTERNS]
+
 
 def is_content_page(text: str) -> bool:
     """コンテンツページかどうか判定
@@ -29,19 +33,19 @@ def is_content_page(text: str) -> bool:
         return False
 
     # ユニーク文字不足（記号・数字だけのページ除外）
-    unique = set(re.sub(r'[\s\d\W]', '', text))
-    if len(unique) < MIN_UNIQUE_CHARS:
+    # re.sub(r'[\s\d\W]', '', text) で残る文字と同じ判定を、先に重複を除いた集合に対して行う
+    unique = sum(1 for c in set(text) if (c.isalnum() or c == '_') and not c.isdecimal())
+    if unique < MIN_UNIQUE_CHARS:
         return False
 
     # ページ番号だけ
-    if re.match(r'^[\d\s\-\.]+$', text):
+    if PAGE_NUMBER_PATTERN.match(text):
         return False
 
     # 除外パターン（短いページのみ）
-    first_line = text.split('\n')[0].strip()
-    for pattern in SKIP_PATTERNS:
-        if re.match(pattern, first_line, re.IGNORECASE):
-            if len(text) < 500:
-                return False
+    if len(text) < 500:
+        first_line = text.split('\n', 1)[0].strip()
+        if any(pattern.match(first_line) for pattern in SKIP_REGEXES):
+            return False
 
     return True
@@ -0,0 +1,150 @@
+"""アップロード処理（保存とジョブ状態）のテスト"""
+
+import asyncio
+import pytest
+import shutil
+import threading
+from pathlib import Path
+from types import SimpleNamespace
+
+from src.api import _process_upload, _save_on_shutdown, search
+from src.processed_files import ProcessedFiles
+from src.rw_lock import ReadWriteLock
+
+
+@pytest.fixture
+def test_dir(tmp_path):
+    """テスト用一時ディレクトリ"""
+    yield tmp_path
+    if tmp_path.exists():
+        shutil.rmtree(tmp_path)
+
+
+class FakeBuilder:
+    def __init__(self, fail_save=False):
+        self.fail_save = fail_save
+        self.saved = 0
+        self.indexed = []
+
+    def prepare_pdf(self, pdf_path, filename):
+        return [{"text": f"本文{i}", "file": filename} for i in range(3)], "OK"
+
+    def embed_chunks(self, metadata):
+        return [[0.0]] * len(metadata), "OK"
+
+    def index_chunks(self, metadata, vectors):
+        self.indexed.extend(metadata)
+        return len(metadata), "OK"
+
+    def save(self):
+        if self.fail_save:
+            raise OSError("disk full")
+        self.saved += 1
+
+
+def make_state(test_dir, builder):
+    return SimpleNamespace(
+        builder=builder,
+        processed_files=ProcessedFiles(test_dir / "processed_files.txt"),
+        jobs={},
+        upload_lock=asyncio.Lock(),
+        index_lock=ReadWriteLock(),
+        status_cache=None,
+        unsaved=False,
+        pending_jobs=[],
+    )
+
+
+def upload(state, filename):
+    job = {"status": "queued", "filename": filename}
+    state.jobs[filename] = job
+    asyncio.run(_process_upload(state, job, Path("dummy.pdf"), filename))
+    return job
+
+
+class TestProcessUpload:
+    def test_done_after_save(self, test_dir):
+        """保存に成功してからdoneになり、処理済みとして記録される"""
+        state = make_state(test_dir, FakeBuilder())
+        job = upload(state, "本.pdf")
+
+        assert job["status"] == "done"
+        assert job["texts_count"] == 3
+        assert state.builder.saved == 1
+        assert "本.pdf" in state.processed_files
+        assert (test_dir / "processed_files.txt").read_text(encoding="utf-8") == "本.pdf\n"
+
+    def test_save_failure_retried(self, test_dir):
+        """保存に失敗したら保存待ちのまま残し、次のアップロード後に保存し直す（再アップロードで二重に追加しない）"""
+        state = make_state(test_dir, FakeBuilder(fail_save=True))
+        job = upload(state, "本.pdf")
+
+        assert job["status"] == "processing"
+        assert "disk full" in job["save_error"]
+        assert "本.pdf" in state.processed_files
+        assert state.pending_jobs == [job]
+        assert state.unsaved
+
+        state.builder.fail_save = False
+        retry = upload(state, "本.pdf")
+
+        assert retry["status"] == "error"
+        assert job["status"] == "done"
+        assert "save_error" not in job
+        assert state.builder.saved == 1
+        assert [m["file"] for m in state.builder.indexed].count("本.pdf") == 3
+        assert (test_dir / "processed_files.txt").read_text(encoding="utf-8") == "本.pdf\n"
+
+    def test_save_on_shutdown(self, test_dir):
+        """保存に失敗したままの追加は終了時に保存する"""
+        state = make_state(test_dir, FakeBuilder(fail_save=True))
+        job = upload(state, "本.pdf")
+
+        state.builder.fail_save = False
+        asyncio.run(_save_on_shutdown(state))
+
+        assert job["status"] == "done"
+        assert state.builder.saved == 1
+        assert not state.unsaved
+
+    def test_search_during_embedding(self, test_dir):
+        """アップロードの埋め込み中も検索はロックを待たずに完了する"""
+        embedding = threading.Event()
+        release = threading.Event()
+
+        class SlowBuilder(FakeBuilder):
+            def embed_chunks(self, metadata):
+                embedding.set()
+                release.wait(5)
+                return super().embed_chunks(metadata)
+
+        class FakeBatcher:
+            async def embed(self, query):
+                return [0.0]
+
+        class FakeSearcher:
+            def search_with_query_vector(self, query, query_vec, top_k, config):
+                return [({"text": "結果", "file": "既存.pdf", "page": 0}, 1.0)]
+
+        state = make_state(test_dir, SlowBuilder())
+        state.query_batcher = FakeBatcher()
+        state.hybrid_searcher = FakeSearcher()
+        request = SimpleNamespace(app=SimpleNamespace(state=state))
+        job = {"status": "queued", "filename": "本.pdf"}
+
+        async def scenario():
+            task = asyncio.create_task(_process_upload(state, job, Path("dummy.pdf"), "本.pdf"))
+            try:
+                assert await asyncio.to_thread(embedding.wait, 5)
+                response = await asyncio.wait_for(
+                    search(request, "クエリ", top_k=3, mode="hybrid", ef_search=None), 1
+                )
+                assert job["status"] == "processing"
+            finally:
+                release.set()
+                await task
+            return response
+
+        response = asyncio.run(scenario())
+        assert [r.file for r in response.results] == ["既存.pdf"]
+        assert job["status"] == "done"
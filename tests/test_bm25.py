@@ -81,3 +81,92 @@ class TestBM25Indexer:
 
         assert deleted > 0
         assert bm25.vocab_size < original_vocab
+
+    def test_postings_roundtrip(self, test_dir):
+        """postingsのエンコードとデコード（tf上限65535、幅の切り替え）"""
+        bm25 = BM25Indexer(db_path=str(test_dir / "bm25.db"))
+
+        for postings in [{5: 3, 1: 70000, 2: 1}, {0: 1}, {3: 2, 100000: 1, 300: 255}]:
+            blob = bm25._encode_postings(postings)
+            expected = {d: min(tf, 65535) for d, tf in postings.items()}
+            assert bm25._postings_dict(blob) == expected
+
+        # 小さな差分・tfは1byteずつ
+        assert len(bm25._encode_postings({i: 1 for i in range(100)})) == 1 + 100 * 2
+
+    def test_migrate_legacy_postings(self, test_dir):
+        """旧形式（<IH の連続）のpostingsを読み込み時に変換"""
+        import sqlite3
+        import struct
+
+        db_path = test_dir / "bm25.db"
+        bm25 = BM25Indexer(db_path=str(db_path), min_df=1)
+        bm25.add(["ラーメン", "ラーメン屋", "カフェ"])
+        expected = bm25.search("ラーメン")
+        bm25._conn.close()
+
+        # 旧形式のDBを再現
+        conn = sqlite3.connect(db_path)
+        rows = conn.execute("SELECT term, postings FROM terms").fetchall()
+        for term, blob in rows:
+            postings = bm25._postings_dict(blob)
+            legacy = b''.join(struct.pack('<IH', d, tf) for d, tf in sorted(postings.items()))
+            conn.execute("UPDATE terms SET postings = ? WHERE term = ?", (legacy, term))
+        conn.execute("DELETE FROM stats WHERE key = 'postings_format'")
+        conn.commit()
+        conn.close()
+
+        migrated = BM25Indexer(db_path=str(db_path), min_df=1)
+        assert migrated.search("ラーメン") == expected
+
+    def test_search_after_incremental_add(self, test_dir):
+        """追加後の検索で新しい文書も対象になる（文書長キャッシュの破棄）"""
+        bm25 = BM25Indexer(db_path=str(test_dir / "bm25.db"), min_df=1)
+        bm25.add(["ラーメンの名店", "カフェの紹介"])
+        assert [d for d, _ in bm25.search("ラーメン")] == [0]
+
+        bm25.add(["ラーメンとラーメン"])
+        results = bm25.search("ラーメン", top_k=1)
+        assert len(results) == 1
+        assert {d for d, _ in bm25.search("ラーメン")} == {0, 2}
+
+    def test_merge_postings(self, test_dir):
+        """末尾への追加と、doc_idが前後する場合のマージ（幅の切り替えを含む）"""
+        bm25 = BM25Indexer(db_path=str(test_dir / "bm25.db"))
+        blob = bm25._encode_postings({1: 2, 5: 1})
+
+        df, appended = bm25._merge_postings(blob, {70000: 300, 6: 1})
+        assert df == 4
+        assert bm25._postings_dict(appended) == {1: 2, 5: 1, 6: 1, 70000: 300}
+
+        df, merged = bm25._merge_postings(blob, {5: 4, 0: 1})
+        assert df == 3
+        assert bm25._postings_dict(merged) == {0: 1, 1: 2, 5: 4}
+
+    def test_migrate_from_json(self, test_dir):
+        """旧JSON形式から移行（min_df未満の語は削除）"""
+        import orjson
+
+        (test_dir / "bm25_stats.json").write_bytes(orjson.dumps({
+            "doc_lens": [3, 4],
+            "corpus_size": 2,
+            "avgdl": 3.5,
+            "inverted_index": {"ラー": {"0": 1, "1": 2}, "カフェ": {"1": 1}},
+        }))
+        bm25 = BM25Indexer(db_path=str(test_dir / "bm25.db"), min_df=2)
+        bm25.load(str(test_dir))
+
+        assert bm25.corpus_size == 2
+        assert bm25.vocab_size == 1
+        assert [d for d, _ in bm25.search("ラー")] == [1, 0]
+        assert (test_dir / "bm25_stats.json.old").exists()
+
+    def test_query_term_frequency(self, test_dir):
+        """クエリ内で繰り返した語はその回数分スコアに寄与する"""
+        bm25 = BM25Indexer(db_path=str(test_dir / "bm25.db"), min_df=1)
+        bm25.add(["ラーメンの名店", "カフェの紹介"])
+
+        [(doc_id, once)] = bm25.search("ラーメン")
+        [(_, twice)] = bm25.search("ラーメン ラーメン")
+        assert doc_id == 0
+        assert twice == pytest.approx(once * 2)
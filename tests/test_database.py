@@ -0,0 +1,71 @@
+"""Databaseのテスト"""
+
+import pytest
+import shutil
+import sqlite3
+import unicodedata
+
+from src.database import Database
+
+
+@pytest.fixture
+def test_dir(tmp_path):
+    """テスト用一時ディレクトリ"""
+    yield tmp_path
+    if tmp_path.exists():
+        shutil.rmtree(tmp_path)
+
+
+class TestDatabase:
+    def test_get_metadata_by_file_normalizes_name(self, test_dir):
+        """NFD形式のファイル名でもNFCで保存・検索される"""
+        nfd = unicodedata.normalize('NFD', "データベース.pdf")
+        db = Database(db_path=str(test_dir / "metadata.db"))
+        db.add_metadata([
+            {"text": "2ページ目", "file": nfd, "page": 1},
+            {"text": "1ページ目", "file": nfd, "page": 0},
+        ])
+        db.flush()
+
+        nfc = unicodedata.normalize('NFC', nfd)
+        assert db.get_file_list() == [nfc]
+        assert [m["text"] for m in db.get_metadata_by_file(nfd)] == ["1ページ目", "2ページ目"]
+        assert len(db.get_metadata_by_file(nfc)) == 2
+
+    def test_migrate_unnormalized_file_names(self, test_dir):
+        """旧形式のDBに残るNFDのファイル名は開いた時にNFCへ揃える"""
+        path = test_dir / "metadata.db"
+        nfd = unicodedata.normalize('NFD', "ガイド.pdf")
+        conn = sqlite3.connect(path)
+        conn.execute("CREATE TABLE metadata (id INTEGER PRIMARY KEY, text TEXT NOT NULL, file TEXT NOT NULL, page INTEGER NOT NULL)")
+        conn.execute("INSERT INTO metadata VALUES (0, '本文', ?, 0)", (nfd,))
+        conn.commit()
+        conn.close()
+
+        db = Database(db_path=str(path))
+        nfc = unicodedata.normalize('NFC', nfd)
+        assert db.get_file_list() == [nfc]
+        assert db.get_metadata_by_file(nfc) == [{"text": "本文", "page": 0}]
+
+    def test_get_metadata_keeps_requested_order(self, test_dir, monkeypatch):
+        """要求したID順で返し、存在しないIDは除く（チャンク境界をまたいでも同じ）"""
+        monkeypatch.setattr("src.database.METADATA_CHUNK_SIZE", 2)
+        db = Database(db_path=str(test_dir / "metadata.db"))
+        db.add_metadata([{"text": f"本文{i}", "file": "a.pdf", "page": i} for i in range(5)])
+        db.flush()
+
+        results = db.get_metadata([3, 0, 99, 4, 1])
+        assert [m["page"] for m in results] == [3, 0, 4, 1]
+        assert results[0] == {"text": "本文3", "file": "a.pdf", "page": 3}
+
+    def test_get_metadata_map(self, test_dir):
+        """IDをキーにした辞書で返し、存在しないIDは含まない"""
+        db = Database(db_path=str(test_dir / "metadata.db"))
+        db.add_metadata([{"text": f"本文{i}", "file": "a.pdf", "page": i} for i in range(3)])
+        db.flush()
+
+        assert db.get_metadata_map([2, 99, 0]) == {
+            2: {"text": "本文2", "file": "a.pdf", "page": 2},
+            0: {"text": "本文0", "file": "a.pdf", "page": 0},
+        }
+        assert db.get_metadata_map([]) == {}
@@ -39,7 +39,23 @@ class TestEmbedder:
 
         assert isinstance(vectors, np.ndarray)
         assert vectors.shape == (3, 512)
+        # Indexerにコピーなしで渡せる形（float32・C連続・L2正規化済み）
+        assert vectors.dtype == np.float32
+        assert vectors.flags["C_CONTIGUOUS"]
+        assert np.allclose(np.linalg.norm(vectors, axis=1), 1, atol=1e-3)
 
     def test_dimension(self, embedder):
         """次元数"""
         assert embedder.dimension == 512
+
+
+class TestFingerprint:
+    def test_precision_suffix(self, monkeypatch):
+        """推論精度ごとにキャッシュの指紋を分ける"""
+        import src.embedder as embedder_module
+        monkeypatch.setattr(embedder_module, "load_model", lambda *args: None)
+
+        fp32 = Embedder(device="cpu", quantize=False).fingerprint
+        assert fp32 == embedder_module.MODEL_FINGERPRINT
+        assert Embedder(device="cpu", quantize=True).fingerprint == fp32 + "+int8"
+        assert Embedder(device="cuda", quantize=True).fingerprint == fp32 + "+fp16"
@@ -0,0 +1,105 @@
+"""EmbeddingCacheのテスト"""
+
+import pytest
+import shutil
+import numpy as np
+
+from src.embedding_cache import EmbeddingCache
+
+
+@pytest.fixture
+def test_dir(tmp_path):
+    """テスト用一時ディレクトリ"""
+    yield tmp_path
+    if tmp_path.exists():
+        shutil.rmtree(tmp_path)
+
+
+class TestEmbeddingCache:
+    def test_get_or_compute(self, test_dir):
+        """2回目以降はキャッシュから返す"""
+        cache = EmbeddingCache(db_path=str(test_dir / "cache.db"), fingerprint="model@v1")
+        calls = []
+
+        def compute(text):
+            calls.append(text)
+            return np.arange(4, dtype=np.float32)
+
+        v1 = cache.get_or_compute("ラーメン", compute)
+        v2 = cache.get_or_compute("ラーメン", compute)
+
+        assert len(calls) == 1
+        assert np.array_equal(v1, v2)
+        assert v2.dtype == np.float32
+        assert (cache.hits, cache.misses) == (1, 1)
+
+    def test_fingerprint_isolation(self, test_dir):
+        """モデル指紋が異なればヒットしない"""
+        db_path = str(test_dir / "cache.db")
+        EmbeddingCache(db_path=db_path, fingerprint="model@v1").put("テスト", np.ones(4))
+
+        assert EmbeddingCache(db_path=db_path, fingerprint="model@v2").get("テスト") is None
+        assert EmbeddingCache(db_path=db_path, fingerprint="model@v1").get("テスト") is not None
+
+    def test_persistence(self, test_dir):
+        """再オープン後もエントリが残る"""
+        db_path = str(test_dir / "cache.db")
+        cache = EmbeddingCache(db_path=db_path)
+        cache.put("a", np.ones(4))
+        cache.put("b", np.zeros(4))
+
+        assert len(EmbeddingCache(db_path=db_path)) == 2
+
+    def test_quantize(self, test_dir):
+        """int8量子化: 近似値を返し、ヒット時とミス時で同じ値になる"""
+        cache = EmbeddingCache(db_path=str(test_dir / "cache.db"), quantize=True)
+        rng = np.random.default_rng(0)
+        vector = rng.standard_normal(512).astype(np.float32)
+
+        missed = cache.get_or_compute("クエリ", lambda _: vector)
+        hit = cache.get_or_compute("クエリ", lambda _: vector)
+
+        assert np.array_equal(missed, hit)
+        assert hit.dtype == np.float32
+        assert np.abs(hit - vector).max() <= np.abs(vector).max() / 127
+
+    def test_get_or_compute_many(self, test_dir):
+        """ミスした分だけまとめて計算し、入力順に返す"""
+        cache = EmbeddingCache(db_path=str(test_dir / "cache.db"))
+        cache.put("b", np.full(4, 2, dtype=np.float32))
+        calls = []
+
+        def compute(texts):
+            calls.append(list(texts))
+            return np.array([np.full(4, len(t)) for t in texts], dtype=np.float32)
+
+        vectors = cache.get_or_compute_many(["aaa", "b", "cc"], compute)
+
+        assert calls == [["aaa", "cc"]]
+        assert vectors[:, 0].tolist() == [3, 2, 2]
+        assert (cache.hits, cache.misses) == (1, 2)
+
+    def test_get_many_and_put_many(self, test_dir):
+        """まとめて保存・取得（重複やチャンク境界をまたぐ入力も入力順に返す）"""
+        cache = EmbeddingCache(db_path=str(test_dir / "cache.db"))
+        texts = [f"文書{i}" for i in range(1000)]
+        cache.put_many(texts, np.arange(1000, dtype=np.float32)[:, None].repeat(4, axis=1))
+
+        vectors = cache.get_many(["文書999", "なし", "文書0", "文書999"])
+        assert vectors[1] is None
+        assert [v[0] for v in vectors if v is not None] == [999, 0, 999]
+        assert len(cache) == 1000
+
+    def test_half(self, test_dir):
+        """float16保存: ヒット時とミス時で同じ値になり、他の形式とはキーが分かれる"""
+        db_path = str(test_dir / "cache.db")
+        cache = EmbeddingCache(db_path=db_path, half=True)
+        vector = np.random.default_rng(0).standard_normal(512).astype(np.float32)
+
+        missed = cache.get_or_compute_many(["文書"], lambda texts: vector[None, :])
+        hit = cache.get_or_compute_many(["文書"], lambda texts: vector[None, :])
+
+        assert np.array_equal(missed, hit)
+        assert hit.dtype == np.float32
+        assert np.allclose(hit[0], vector, atol=1e-2)
+        assert EmbeddingCache(db_path=db_path).get("文書") is None
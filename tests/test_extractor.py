@@ -2,7 +2,8 @@
 
 import pytest
 
-from src.extractor import chunk_text
+from src import extractor
+from src.extractor import chunk_text, extract_from_pdf
 from src.text_filter import is_content_page
 
 
@@ -29,6 +30,49 @@ class TestChunkText:
             assert chunk.endswith("。") or len(chunk) < 100
 
 
+class TestExtractFromPdf:
+    @pytest.fixture
+    def pdf_bytes(self):
+        """ページ番号入りのPDF（並列化の閾値以上のページ数）"""
+        import fitz
+        doc = fitz.open()
+        for i in range(70):
+            page = doc.new_page()
+            if i % 10 != 9:  # 空白ページも混ぜる
+                page.insert_text((72, 72), f"page {i + 1}")
+        data = doc.tobytes()
+        doc.close()
+        return data
+
+    def test_parallel_matches_sequential(self, pdf_bytes, tmp_path):
+        """プロセス並列でも逐次と同じ結果（ページ順）になる"""
+        sequential = extract_from_pdf(pdf_bytes, workers=1)
+        assert len(sequential) == 63
+        assert sequential[0] == {"page": 1, "text": "page 1"}
+
+        assert extract_from_pdf(pdf_bytes, workers=3) == sequential
+
+        path = tmp_path / "doc.pdf"
+        path.write_bytes(pdf_bytes)
+        assert extract_from_pdf(path, workers=2) == sequential
+
+    def test_reuse_executor(self, pdf_bytes):
+        """プロセスプールはPDFごとに作り直さず使い回す"""
+        try:
+            extract_from_pdf(pdf_bytes, workers=2)
+            executor = extractor._executor
+            extract_from_pdf(pdf_bytes, workers=2)
+            assert extractor._executor is executor
+        finally:
+            extractor.shutdown_executor()
+        assert extractor._executor is None
+
+    def test_missing_file(self, tmp_path):
+        """存在しないパスはFileNotFoundError"""
+        with pytest.raises(FileNotFoundError):
+            extract_from_pdf(tmp_path / "none.pdf")
+
+
 class TestTextFilter:
     def test_content_page(self):
         """コンテンツページは通過"""
@@ -50,3 +94,8 @@ class TestTextFilter:
         """数字のみのページはフィルタ"""
         text = "123 456 789 " * 20
         assert is_content_page(text) is False
+
+    def test_symbols_and_fullwidth_digits_filtered(self):
+        """記号・全角数字は文字の種類に数えない"""
+        text = "（１２３４５６７８９０）・、。「」【】―…＊＃％＆＠" * 10 + "あいうえおかきくけこ"
+        assert is_content_page(text) is False
@@ -0,0 +1,95 @@
+"""HybridSearcherのテスト"""
+
+import pytest
+from types import SimpleNamespace
+
+from src.hybrid_searcher import HybridSearcher, SearchConfig
+
+
+class FakeDatabase:
+    """IDリストに対応するメタデータを返すダミーDB"""
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.calls = []
+
+    def get_metadata_map(self, ids):
+        self.calls.append(sorted(ids))
+        return {i: self.rows[i] for i in ids if i in self.rows}
+
+
+class FakeIndexer:
+    def __init__(self, rows, hits):
+        self.db = FakeDatabase(rows)
+        self.hits = hits
+
+    def search_ids(self, query_vector, top_k, ef_search=None):
+        return self.hits[:top_k]
+
+
+def make_searcher(rows, vector_hits=(), bm25_hits=()):
+    bm25 = SimpleNamespace(search=lambda query, top_k: list(bm25_hits)[:top_k])
+    return HybridSearcher(embedder=None, indexer=FakeIndexer(rows, list(vector_hits)), bm25=bm25)
+
+
+ROWS = {
+    0: {"text": "A", "file": "a.pdf", "page": 0},
+    1: {"text": "B", "file": "b.pdf", "page": 3},
+    2: {"text": "C", "file": "c.pdf", "page": 0},
+}
+
+
+class TestRRF:
+    def test_fuse_by_file_and_page(self):
+        """同じページは両方の順位のスコアを合計し、高い順に並ぶ"""
+        searcher = make_searcher(ROWS)
+        vector_results = [(ROWS[1], 0.9), (ROWS[2], 0.8)]
+        bm25_results = [(ROWS[0], 5.0), (ROWS[1], 4.0)]
+
+        fused = searcher._rrf(vector_results, bm25_results, k=60)
+
+        assert [m["text"] for m, _ in fused] == ["B", "A", "C"]
+        assert fused[0][1] == 1 / 61 + 1 / 62
+        assert fused[1][1] == 1 / 61
+
+
+class TestSearchWithQueryVector:
+    def test_fetch_metadata_once(self):
+        """ベクトルとBM25の結果のメタデータを1回でまとめて取得する"""
+        searcher = make_searcher(ROWS, vector_hits=[(1, 0.9), (2, 0.8)], bm25_hits=[(0, 5.0), (1, 4.0), (99, 1.0)])
+        config = SearchConfig(use_rerank=False)
+
+        results = searcher.search_with_query_vector("クエリ", None, top_k=3, config=config)
+
+        assert [m["text"] for m, _ in results] == ["B", "A", "C"]
+        assert searcher.indexer.db.calls == [[0, 1, 2, 99]]
+
+    def test_vector_only(self):
+        """BM25なしならベクトル検索の結果をそのまま返す"""
+        searcher = make_searcher(ROWS, vector_hits=[(2, 0.8), (0, 0.5)])
+        config = SearchConfig(use_bm25=False, use_rerank=False)
+
+        results = searcher.search_with_query_vector("クエリ", None, top_k=5, config=config)
+
+        assert results == [(ROWS[2], 0.8), (ROWS[0], 0.5)]
+
+    def test_blend_rerank_scores(self, monkeypatch):
+        """リランカーのスコア（シグモイド正規化）とRRFスコアをブレンドして並べ替える"""
+        import math
+        import src.hybrid_searcher as hybrid_searcher
+
+        class FakeReranker:
+            def rerank(self, query, candidates):
+                scores = {"A": 3.0, "B": -1.0, "C": 0.0}
+                return [(m, scores[m["text"]]) for m, _ in candidates]
+
+        monkeypatch.setattr(hybrid_searcher, "get_reranker", lambda: FakeReranker())
+        searcher = make_searcher(ROWS, vector_hits=[(1, 0.9), (2, 0.8)], bm25_hits=[(0, 5.0), (1, 4.0)])
+        config = SearchConfig(rerank_weight=0.5)
+
+        results = searcher.search_with_query_vector("クエリ", None, top_k=2, config=config)
+
+        max_rrf = 1 / 61 + 1 / 62
+        expected_a = 0.5 / (1 + math.exp(-3.0)) + 0.5 * (1 / 61) / max_rrf
+        assert [m["text"] for m, _ in results] == ["A", "B"]
+        assert results[0][1] == pytest.approx(expected_a)
@@ -99,3 +99,65 @@ class TestIndexer:
         results = indexer.search(query_vec, top_k=10)
 
         assert len(results) == 0
+
+    def test_auto_tune_nprobe(self, test_dir):
+        """nprobe未指定なら訓練時に自動調整し、保存・読み込み後も引き継ぐ"""
+        from src.database import Database
+        rng = np.random.default_rng(0)
+        vectors = rng.standard_normal((800, 512)).astype(np.float32)
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        metadata = [{"text": str(i), "file": "test.pdf", "page": i} for i in range(len(vectors))]
+
+        indexer = Indexer(index_key="IVF16,PQ16x4fs", nprobe=None)
+        indexer.db = Database(db_path=str(test_dir / "metadata.db"))
+        indexer.add(vectors, metadata)
+
+        assert indexer.is_trained
+        assert 1 <= indexer.nprobe <= 16
+        indexer.save(str(test_dir))
+
+        loaded = Indexer(nprobe=None)
+        loaded.db = Database(db_path=str(test_dir / "metadata.db"))
+        loaded.load(str(test_dir))
+        assert loaded.nprobe == indexer.nprobe
+
+        fixed = Indexer(nprobe=3)
+        fixed.db = Database(db_path=str(test_dir / "metadata.db"))
+        fixed.load(str(test_dir))
+        assert fixed.nprobe == 3
+
+    def test_search_ids_batch(self, test_dir):
+        """まとめて検索してもクエリごとの検索と同じ結果になる"""
+        from src.database import Database
+        rng = np.random.default_rng(0)
+        vectors = rng.standard_normal((50, 512)).astype(np.float32)
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        metadata = [{"text": str(i), "file": "test.pdf", "page": i} for i in range(len(vectors))]
+
+        indexer = Indexer()
+        indexer.db = Database(db_path=str(test_dir / "metadata.db"))
+        assert indexer.search_ids_batch(vectors[:2], top_k=3) == [[], []]
+        indexer.add(vectors, metadata)
+
+        batched = indexer.search_ids_batch(vectors[:4], top_k=3)
+        assert batched == [indexer.search_ids(v, top_k=3) for v in vectors[:4]]
+        assert [hits[0][0] for hits in batched] == [0, 1, 2, 3]
+
+    def test_search_batch_queries(self, test_dir, embedder, sample_data):
+        """複数クエリを1回で埋め込み、まとめて検索する"""
+        texts, metadata, vectors = sample_data
+
+        from src.database import Database
+        indexer = Indexer()
+        indexer.db = Database(db_path=str(test_dir / "metadata.db"))
+        indexer.add(vectors, metadata)
+
+        queries = ["ラーメンが食べたい", "魚介が新鮮な店", "落ち着いたカフェ"]
+        query_vectors = embedder.generate_query_embeddings(queries)
+        results = indexer.search_ids_batch(query_vectors, top_k=3)
+
+        assert len(results) == len(queries)
+        top_texts = [texts[hits[0][0]] for hits in results]
+        assert "ラーメン" in top_texts[0] or "豚骨" in top_texts[0] or "中華そば" in top_texts[0]
+        assert "魚介" in top_texts[1]
+        assert "カフェ" in top_texts[2]
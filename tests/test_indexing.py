@@ -0,0 +1,121 @@
+"""IndexBuilderのテスト"""
+
+import numpy as np
+
+from src.indexing import IndexBuilder
+
+
+class FakeEmbedder:
+    """テキスト長をベクトル化するダミー埋め込み器"""
+
+    dimension = 4
+
+    def __init__(self):
+        self.calls = []
+
+    def generate_document_embeddings(self, texts, batch_size=32):
+        self.calls.append(list(texts))
+        return np.array([[len(t), 1, 0, 0] for t in texts], dtype=np.float32)
+
+
+def make_builder(embedder):
+    # indexer/bm25はベクトル生成では使わないためダミーを渡す
+    return IndexBuilder(embedder=embedder, indexer=object(), bm25=object())
+
+
+class TestGenerateVectorsBatch:
+    def test_shape_and_order(self):
+        """入力順にベクトルが並ぶ"""
+        builder = make_builder(FakeEmbedder())
+        vectors = builder._generate_vectors_batch(["a", "bb", "ccc"])
+
+        assert vectors.dtype == np.float32
+        assert vectors.shape == (3, 4)
+        assert vectors[:, 0].tolist() == [1, 2, 3]
+
+    def test_deduplicate(self):
+        """同一テキストは1回だけ埋め込む"""
+        embedder = FakeEmbedder()
+        builder = make_builder(embedder)
+        vectors = builder._generate_vectors_batch(["ヘッダ", "本文です", "ヘッダ"])
+
+        embedded = [t for batch in embedder.calls for t in batch]
+        assert sorted(embedded) == sorted(["ヘッダ", "本文です"])
+        assert vectors.shape == (3, 4)
+        assert np.array_equal(vectors[0], vectors[2])
+        assert vectors[1, 0] == 4
+
+    def test_batch_by_length(self, monkeypatch):
+        """長さの近いテキストを同じバッチにまとめ、結果は入力順に戻す"""
+        import src.indexing as indexing
+        monkeypatch.setattr(indexing, "BATCH_SIZE", 2)
+
+        embedder = FakeEmbedder()
+        builder = make_builder(embedder)
+        texts = ["a", "dddd", "bb", "eeeee", "ccc"]
+        vectors = builder._generate_vectors_batch(texts)
+
+        assert [sorted(len(t) for t in batch) for batch in embedder.calls] == [[4, 5], [2, 3], [1]]
+        assert vectors[:, 0].tolist() == [1, 4, 2, 5, 3]
+
+
+class FakeIndexer:
+    def __init__(self):
+        self.metadata = []
+
+    def add(self, vectors, metadata):
+        self.metadata.extend(metadata)
+
+
+class FakeBM25:
+    def add(self, texts):
+        pass
+
+
+class TestAddPdf:
+    def test_skip_short_chunks(self, monkeypatch):
+        """ページ末尾の短い切れ端チャンクは埋め込まない"""
+        import src.indexing as indexing
+
+        long_text = "あ" * 300 + "。" + "う" * 195 + "。" + "い" * 10 + "。"
+        monkeypatch.setattr(indexing, "extract_from_pdf", lambda _: [{"page": 1, "text": long_text}])
+        monkeypatch.setattr(indexing, "is_content_page", lambda _: True)
+
+        indexer = FakeIndexer()
+        builder = IndexBuilder(embedder=FakeEmbedder(), indexer=indexer, bm25=FakeBM25())
+        count, _ = builder.add_pdf(b"", "test.pdf")
+
+        assert count == 1
+        assert all(len(m["text"]) >= indexing.MIN_CHUNK_LENGTH for m in indexer.metadata)
+
+    def test_prepare_then_add_chunks(self, monkeypatch):
+        """prepare_pdfは埋め込まず、add_chunksで初めて埋め込んで追加する"""
+        import src.indexing as indexing
+
+        monkeypatch.setattr(indexing, "extract_from_pdf", lambda _: [{"page": 2, "text": "本文" * 20}])
+        monkeypatch.setattr(indexing, "is_content_page", lambda _: True)
+
+        embedder = FakeEmbedder()
+        indexer = FakeIndexer()
+        builder = IndexBuilder(embedder=embedder, indexer=indexer, bm25=FakeBM25())
+
+        metadata, msg = builder.prepare_pdf(b"", "test.pdf")
+        assert msg == "OK"
+        assert metadata == [{"text": "本文" * 20, "file": "test.pdf", "page": 1, "chunk": 0}]
+        assert embedder.calls == []
+
+        assert builder.add_chunks(metadata) == (1, "OK")
+        assert indexer.metadata == metadata
+
+    def test_prepare_error(self, monkeypatch):
+        """抽出エラーは例外にせずメッセージで返す"""
+        import src.indexing as indexing
+
+        def broken(_):
+            raise RuntimeError("壊れたPDF")
+
+        monkeypatch.setattr(indexing, "extract_from_pdf", broken)
+        builder = IndexBuilder(embedder=FakeEmbedder(), indexer=FakeIndexer(), bm25=FakeBM25())
+
+        assert builder.prepare_pdf(b"", "test.pdf") == ([], "壊れたPDF")
+        assert builder.add_pdf(b"", "test.pdf") == (0, "壊れたPDF")
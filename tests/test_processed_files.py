@@ -0,0 +1,89 @@
+"""ProcessedFilesのテスト"""
+
+import pytest
+import shutil
+
+from src.processed_files import ProcessedFiles
+
+
+@pytest.fixture
+def test_dir(tmp_path):
+    """テスト用一時ディレクトリ"""
+    yield tmp_path
+    if tmp_path.exists():
+        shutil.rmtree(tmp_path)
+
+
+class TestProcessedFiles:
+    def test_save_and_load(self, test_dir):
+        """保存と読み込み"""
+        path = test_dir / "processed_files.txt"
+        files = ProcessedFiles(path)
+        files.add("本.pdf")
+        files.add("論文.pdf")
+        files.save()
+
+        loaded = ProcessedFiles(path)
+        loaded.load()
+        assert len(loaded) == 2
+        assert "本.pdf" in loaded
+
+    def test_skip_unchanged(self, test_dir):
+        """変更がなければ書き込まない"""
+        files = ProcessedFiles(test_dir / "processed_files.txt")
+        files.add("a.pdf")
+
+        assert files.save() is True
+        assert files.save() is False
+
+        files.add("a.pdf")
+        assert files.save() is False
+
+        files.add("b.pdf")
+        assert files.save() is True
+
+    def test_no_temp_file_left(self, test_dir):
+        """一時ファイルが残らない"""
+        files = ProcessedFiles(test_dir / "processed_files.txt")
+        files.add("a.pdf")
+        files.save()
+
+        assert [p.name for p in test_dir.iterdir()] == ["processed_files.txt"]
+
+    def test_migrate_legacy_json(self, test_dir):
+        """旧形式のJSONから読み込み、新形式で保存"""
+        (test_dir / "processed_files.json").write_text('["旧.pdf", "b.pdf"]', encoding='utf-8')
+
+        files = ProcessedFiles(test_dir / "processed_files.txt")
+        files.load()
+        assert "旧.pdf" in files
+        assert files.save() is True
+
+        reloaded = ProcessedFiles(test_dir / "processed_files.txt")
+        reloaded.load()
+        assert set(reloaded) == {"旧.pdf", "b.pdf"}
+
+    def test_append_only(self, test_dir):
+        """2回目以降の保存は追加分だけを追記する"""
+        path = test_dir / "processed_files.txt"
+        files = ProcessedFiles(path)
+        files.add("b.pdf")
+        files.save()
+        files.add("a.pdf")
+        files.save()
+
+        assert path.read_text(encoding='utf-8') == "b.pdf\na.pdf\n"
+
+    def test_append_to_file_without_trailing_newline(self, test_dir):
+        """末尾に改行のない既存ファイルにも正しく追記する"""
+        path = test_dir / "processed_files.txt"
+        path.write_text("a.pdf\nb.pdf", encoding='utf-8')
+
+        files = ProcessedFiles(path)
+        files.load()
+        files.add("c.pdf")
+        files.save()
+
+        reloaded = ProcessedFiles(path)
+        reloaded.load()
+        assert set(reloaded) == {"a.pdf", "b.pdf", "c.pdf"}
@@ -0,0 +1,76 @@
+"""QueryBatcherのテスト"""
+
+import asyncio
+import numpy as np
+import pytest
+
+from src.query_batcher import QueryBatcher
+
+
+class TestQueryBatcher:
+    def test_concurrent_queries_are_batched(self):
+        """同時に届いたクエリは1回の呼び出しにまとまる"""
+        calls = []
+
+        def embed_batch(queries):
+            calls.append(list(queries))
+            return np.array([[len(q), 0] for q in queries], dtype=np.float32)
+
+        async def main():
+            batcher = QueryBatcher(embed_batch, max_wait=0.05)
+            return await asyncio.gather(*(batcher.embed(q) for q in ["a", "bb", "ccc"]))
+
+        vectors = asyncio.run(main())
+
+        assert calls == [["a", "bb", "ccc"]]
+        assert [v[0] for v in vectors] == [1, 2, 3]
+
+    def test_max_batch_size(self):
+        """max_batch_sizeに達したら分割して実行"""
+        calls = []
+
+        def embed_batch(queries):
+            calls.append(len(queries))
+            return np.zeros((len(queries), 2), dtype=np.float32)
+
+        async def main():
+            batcher = QueryBatcher(embed_batch, max_batch_size=2, max_wait=0.05)
+            return await asyncio.gather(*(batcher.embed(str(i)) for i in range(5)))
+
+        vectors = asyncio.run(main())
+
+        assert len(vectors) == 5
+        assert sorted(calls) == [1, 2, 2]
+
+    def test_error_propagates(self):
+        """埋め込みの例外は各呼び出し元に伝わる"""
+        def embed_batch(queries):
+            raise RuntimeError("boom")
+
+        async def main():
+            batcher = QueryBatcher(embed_batch, max_wait=0.01)
+            await batcher.embed("a")
+
+        with pytest.raises(RuntimeError):
+            asyncio.run(main())
+
+    def test_cache(self):
+        """同じクエリは再計算しない"""
+        calls = []
+
+        def embed_batch(queries):
+            calls.append(list(queries))
+            return np.ones((len(queries), 2), dtype=np.float32)
+
+        async def main():
+            batcher = QueryBatcher(embed_batch, max_wait=0.01, cache_size=1)
+            await batcher.embed("a")
+            await batcher.embed(" a ")
+            await batcher.embed("b")
+            await batcher.embed("a")
+            return batcher
+
+        batcher = asyncio.run(main())
+
+        assert calls == [["a"], ["b"], ["a"]]
+        assert (batcher.hits, batcher.misses) == (1, 3)
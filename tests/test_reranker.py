@@ -0,0 +1,49 @@
+"""Rerankerのテスト"""
+
+import numpy as np
+
+from src.reranker import Reranker
+
+
+class FakeCrossEncoder:
+    """文書の長さをスコアにするダミーモデル"""
+
+    def __init__(self):
+        self.calls = []
+
+    def predict(self, pairs):
+        self.calls.append([text for _, text in pairs])
+        return np.array([len(text) for _, text in pairs], dtype=np.float32)
+
+
+def make_reranker(cache_size=4096):
+    reranker = Reranker(cache_size=cache_size)
+    reranker.model = FakeCrossEncoder()
+    return reranker
+
+
+def make_results(*texts):
+    return [({"text": text}, 0.0) for text in texts]
+
+
+class TestReranker:
+    def test_sort_by_score(self):
+        """短い文書から順にモデルに渡し、スコアは元の文書に対応させる"""
+        reranker = make_reranker()
+        reranked = reranker.rerank("クエリ", make_results("ccc", "a", "ddddd", "bb"))
+
+        assert reranker.model.calls == [["a", "bb", "ccc", "ddddd"]]
+        assert [(m["text"], score) for m, score in reranked] == [
+            ("ddddd", 5.0), ("ccc", 3.0), ("bb", 2.0), ("a", 1.0)
+        ]
+
+    def test_cache(self):
+        """同じクエリと文書のペアは再計算しない"""
+        reranker = make_reranker(cache_size=2)
+        reranker.rerank("クエリ", make_results("a", "bb"))
+        reranked = reranker.rerank("クエリ", make_results("bb", "ccc"), top_k=1)
+        reranker.rerank("別のクエリ", make_results("bb"))
+
+        assert reranker.model.calls == [["a", "bb"], ["ccc"], ["bb"]]
+        assert reranked[0][0]["text"] == "ccc"
+        assert len(reranker._cache) == 2
@@ -0,0 +1,84 @@
+"""ReadWriteLockのテスト"""
+
+import threading
+import time
+
+from src.rw_lock import ReadWriteLock
+
+
+class TestReadWriteLock:
+    def test_readers_share(self):
+        """読み手同士は同時に入れる"""
+        lock = ReadWriteLock()
+        inside = threading.Barrier(2, timeout=1)
+
+        def reader():
+            with lock.read():
+                inside.wait()  # 2つ目の読み手が入れなければタイムアウトする
+
+        threads = [threading.Thread(target=reader) for _ in range(2)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert not inside.broken
+
+    def test_writer_excludes_readers(self):
+        """書き手の実行中は読み手が入れず、書き手の変更を途中で見ない"""
+        lock = ReadWriteLock()
+        state = {"value": 0}
+        seen = []
+        writing = threading.Event()
+
+        def writer():
+            with lock.write():
+                writing.set()
+                state["value"] = 1
+                time.sleep(0.05)
+                state["value"] = 2
+
+        def reader():
+            writing.wait()
+            with lock.read():
+                seen.append(state["value"])
+
+        threads = [threading.Thread(target=writer), threading.Thread(target=reader)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert seen == [2]
+
+    def test_waiting_writer_blocks_new_readers(self):
+        """書き手が待っていれば、後から来た読み手は書き手の後に入る"""
+        lock = ReadWriteLock()
+        order = []
+        first_reader = threading.Event()
+        release = threading.Event()
+
+        def long_reader():
+            with lock.read():
+                first_reader.set()
+                release.wait(1)
+
+        def writer():
+            with lock.write():
+                order.append("writer")
+
+        def late_reader():
+            with lock.read():
+                order.append("reader")
+
+        t1 = threading.Thread(target=long_reader)
+        t1.start()
+        first_reader.wait(1)
+        t2 = threading.Thread(target=writer)
+        t2.start()
+        time.sleep(0.05)  # 書き手を待機状態にする
+        t3 = threading.Thread(target=late_reader)
+        t3.start()
+        time.sleep(0.05)
+        release.set()
+        for t in (t1, t2, t3):
+            t.join()
+        assert order == ["writer", "reader"]